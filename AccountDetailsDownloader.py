@@ -1,55 +1,44 @@
+import asyncio
 import logging
 import os
-import time
-import requests
-import re
-from typing import List, Dict, Optional
-from pydantic import TypeAdapter
+from datetime import datetime
+from typing import List, Optional
 from pypaperless import Paperless
 
-from helpers import Paginator, dump_to_file
-from models.InfaktAccountEvents import InfaktAccountEvent, InfaktAccountEventsResponse, InfaktAccountEventsIgnoreFields
+from helpers import Paginator, dump_to_file, details_in_list
+from InfaktClient import InfaktClient
+from JsonSerializer import json_serializer
+from IncrementalSync import IncrementalSync, WATERMARK_OVERLAP
+from AccountEventsArchive import AccountEventsArchive
+from SyncState import SyncState
+from ListedDataDownloader import ListedDataDownloader
+from models.InfaktAccountEvents import InfaktAccountEvent, InfaktAccountEventsResponse
 from models.InfaktAccountDetails import InfaktAccountDetails, InfaktAccountDetailsIgnoreFields
 from models.InfaktAccountDetails import InfaktClientEntity, InfaktClientsResponse, InfaktClientEntityDetails
 from models.InfaktAccountDetails import InfaktProductEntity, InfaktProductsResponse, InfaktProductEntityDetails
 from models.InfaktAccountDetails import InfaktBankAccountEntity, InfaktBankAccountsResponse, InfaktBankAccountEntityDetails
 
 class AccountDetailsDownloader():
-  def __init__(self, logger: logging.Logger, infakt_session: requests.Session, infakt_domain: str, paperless: Optional[Paperless]):
+  def __init__(self, logger: logging.Logger, infakt_client: InfaktClient, infakt_domain: str, paperless: Optional[Paperless], details_concurrency: int = 8, incremental_sync: Optional[IncrementalSync] = None, sync_state: Optional[SyncState] = None):
     self.logger = logger
-    self.infakt_session = infakt_session
+    self.infakt_client = infakt_client
     self.infakt_domain = infakt_domain
     self.paperless = paperless
+    self.details_concurrency = details_concurrency
+    self.incremental_sync = incremental_sync
+    self.sync_state = sync_state
 
     # Create the required folder
     if not os.path.exists('data/account'): os.mkdir('data/account')
 
   async def download_account_details(self) -> bool:
     try:
-      attempt: int = 0
-      while True:
-        attempt += 1
-        if attempt > 3:
-          raise Exception('Exceeded maximum fetch attempts')
-
-        account_details_result = self.infakt_session.get(f'{self.infakt_domain}/api/v3/account/details.json', headers={
-          "accept": "application/json"
-        })
-        if account_details_result.status_code == 200:
-          break # Fetched successfully
-        elif account_details_result.status_code == 429: # Ratelimited
-          retryAfter = account_details_result.headers['Retry-After']
-          if retryAfter is not None:
-            self.logger.warning(f'Rate limited - waiting {retryAfter} seconds')
-            time.sleep(retryAfter)
-        else:
-          self.logger.warning(f'Received {account_details_result.status_code} error - retrying in 1s')
-          time.sleep(1)
+      account_details_result = await self.infakt_client.get(f'{self.infakt_domain}/api/v3/account/details.json')
       
-      parsed_account_details: InfaktAccountDetails = InfaktAccountDetails.model_validate(account_details_result.json())
+      parsed_account_details: InfaktAccountDetails = InfaktAccountDetails.model_validate_json(account_details_result.content)
       
       # Save to file
-      dump_to_file('data/account/details.json', parsed_account_details.model_dump_json(indent=2, exclude=InfaktAccountDetailsIgnoreFields, exclude_none=True))
+      dump_to_file('data/account/details.json', json_serializer.dump(parsed_account_details, exclude=InfaktAccountDetailsIgnoreFields))
 
       self.logger.info('Finished fetching account details')
       return True
@@ -57,104 +46,81 @@ class AccountDetailsDownloader():
       self.logger.error('Failed to handle account details - %s %s', type(e), e)
       return False
     
-  async def download_account_events(self) -> bool:
-    try:
-      all_events: List[InfaktAccountEvent] = []
-    
-      for events_result in Paginator(self.infakt_session, f'{self.infakt_domain}/api/v3/account/activities.json'):
-        parsed_events: InfaktAccountEventsResponse = InfaktAccountEventsResponse.model_validate(events_result.json())
+  async def fetch_new_events(self, threshold: Optional[datetime]) -> List[InfaktAccountEvent]:
+    events: List[InfaktAccountEvent] = []
+    if threshold is None:
+      # Nothing archived yet - fetch the whole history
+      async for events_result in Paginator(self.infakt_client, f'{self.infakt_domain}/api/v3/account/activities.json', concurrency=self.details_concurrency):
+        parsed_events: InfaktAccountEventsResponse = InfaktAccountEventsResponse.model_validate_json(events_result.content)
         if len(parsed_events.entities) == 0:
           break
-        all_events.extend(parsed_events.entities)
+        events.extend(parsed_events.entities)
+      return events
+
+    # The newest events are listed first, so the pages are walked one by one until the archived ones are reached
+    async for events_result in Paginator(self.infakt_client, f'{self.infakt_domain}/api/v3/account/activities.json', concurrency=1):
+      parsed_events: InfaktAccountEventsResponse = InfaktAccountEventsResponse.model_validate_json(events_result.content)
+      if len(parsed_events.entities) == 0:
+        break
+      if len(events) == 0 and parsed_events.entities[0].performed_at < parsed_events.entities[-1].performed_at:
+        self.logger.warning('Account events are not listed from the newest ones - fetching the whole history')
+        return await self.fetch_new_events(None)
+      events.extend(event for event in parsed_events.entities if event.performed_at >= threshold)
+      if min(event.performed_at for event in parsed_events.entities) < threshold:
+        break
+    return events
+
+  async def download_account_events(self) -> bool:
+    if self.incremental_sync is not None: self.incremental_sync.expect_plan()
+    try:
+      events_archive = AccountEventsArchive(self.logger)
+      events_archive.migrate()
+
+      # Look through the events performed since the newest archived one (and the incremental sync watermark)
+      threshold: Optional[datetime] = None
+      if (latest_performed_at := events_archive.latest_performed_at()) is not None:
+        threshold = datetime.fromisoformat(latest_performed_at)
+        if self.incremental_sync is not None and self.incremental_sync.last_event_at is not None:
+          threshold = min(threshold, self.incremental_sync.last_event_at)
+        threshold -= WATERMARK_OVERLAP # Events are recorded with a delay
+      new_events: List[InfaktAccountEvent] = await self.fetch_new_events(threshold)
 
       # Sort the events in ascending order
-      all_events.sort(key=lambda x: x.performed_at)
+      new_events.sort(key=lambda x: x.performed_at)
 
-      # Save to file
-      dump_to_file('data/account/events.json', TypeAdapter(List[InfaktAccountEvent]).dump_json(all_events, indent=2, exclude=InfaktAccountEventsIgnoreFields, exclude_none=True))
+      # Work out what was changed since the last synchronization
+      if self.incremental_sync is not None:
+        self.incremental_sync.plan(new_events)
+
+      # Append to the monthly segments
+      added_count: int = events_archive.add(new_events)
       
-      self.logger.info('Finished fetching account events')
+      self.logger.info('Finished fetching account events - %d new', added_count)
       return True
     except Exception as e:
       self.logger.error('Failed to handle account events - %s %s', type(e), e)
       return False
+    finally:
+      # Without the events the other categories fall back to fetching everything
+      if self.incremental_sync is not None: self.incremental_sync.finish_planning()
     
-  async def download_listed_data(self, category: str, base_endpoint_url: str, response_model, entity_model, entity_details_model) -> bool:
-    dir_path: str = f'data/account/{category}'
-    try:
-      if not os.path.exists(dir_path): os.mkdir(dir_path)
-      if not os.path.exists(f'{dir_path}/details'): os.mkdir(f'{dir_path}/details')
-    except Exception as e:
-      self.logger.error('Failed to create directories required for account data handling - %s', category)
-      return False
-    
-    try:
-      all_entities = []
-      for data_result in Paginator(self.infakt_session, f'{base_endpoint_url}.json'):
-        parsed_data = response_model.model_validate(data_result.json())
-        if len(parsed_data.entities) == 0:
-          break
-        all_entities.extend(parsed_data.entities)
-
-      # Sort the data in ascending order basing on id
-      all_entities.sort(key=lambda x: x.id)
-
-      # Save the entities list
-      dump_to_file(f'{dir_path}/list.json', TypeAdapter(List[entity_model]).dump_json(all_entities, indent=2, exclude_none=True))
-  
-      entity_id_regex = re.compile(r'\b(\d+)\.')
-      archived_entities_id: Dict[int, str] = { int(result.group(1)): x for x in os.listdir(f'{dir_path}/details') if (result := entity_id_regex.search(x)) is not None }
-
-      for entity in all_entities:
-        attempt: int = 0
-        while True:
-          attempt += 1
-          if attempt > 3:
-            raise Exception('Exceeded maximum fetch attempts')
+  async def download_listed_data(self, category: str, base_endpoint_url: str, response_model, entity_model, entity_details_model, details_from_list: Optional[bool] = None) -> bool:
+    # Detail requests are skipped when the listed entities carry all the fields (detected from the models unless set)
+    if details_from_list is None: details_from_list = details_in_list(entity_model, entity_details_model)
 
-          entity_details_result = self.infakt_session.get(f'{base_endpoint_url}/{entity.id}.json', headers={
-            "accept": "application/json"
-          })
-          if entity_details_result.status_code == 200:
-            break # Fetched successfully
-          elif entity_details_result.status_code == 429: # Ratelimited
-            retryAfter = entity_details_result.headers['Retry-After']
-            if retryAfter is not None:
-              self.logger.warning(f'Rate limited - waiting {retryAfter} seconds')
-              time.sleep(retryAfter)
-          else:
-            self.logger.warning(f'Received {entity_details_result.status_code} error - retrying in 1s')
-            time.sleep(1)
-
-        parsed_entity_details = entity_details_model.model_validate(entity_details_result.json())
-        target_name: str = f'{entity.id}'
-        
-        # Restore the path if already exists
-        if entity.id in archived_entities_id and archived_entities_id[entity.id] != f'{target_name}.json':
-          os.rename(f'{dir_path}/details/{archived_entities_id[entity.id]}', f'{dir_path}/details/{target_name}.json')
-
-        # Save entity to file
-        dump_to_file(f'{dir_path}/details/{target_name}.json', parsed_entity_details.model_dump_json(indent=2, exclude_none=True))
-       
-      # Adjust deleted data names
-      deleted_entities_id = archived_entities_id.keys() - [entity.id for entity in all_entities]
-      for deleted_entity_id in deleted_entities_id:
-        target_name: str = f'(DELETED) {deleted_entity_id}'
-        if archived_entities_id[deleted_entity_id] != target_name:
-          os.rename(f'{dir_path}/details/{archived_entities_id[deleted_entity_id]}', f'{dir_path}/details/{target_name}.json')
-
-      self.logger.info('Finished fetching account data - %s', category)
-      return True
-    except Exception as e:
-      self.logger.error('Failed to handle account data - %s %s %s', category, type(e), e)
-      return False
+    listed_data = ListedDataDownloader(self.logger, self.infakt_client, category, f'data/account/{category}', base_endpoint_url, response_model, entity_details_model, 'account data', details_concurrency=self.details_concurrency, incremental_sync=self.incremental_sync, sync_state=self.sync_state, details_from_list=details_from_list)
+    return await listed_data.process()
 
   async def process(self) -> bool:
-    results: List[bool] = [
-      await self.download_account_details(),
-      await self.download_account_events(),
-      await self.download_listed_data('PRODUCTS', f'{self.infakt_domain}/api/v3/products', entity_model=InfaktProductEntity, response_model=InfaktProductsResponse, entity_details_model=InfaktProductEntityDetails),
-      await self.download_listed_data('BANK_ACCOUNTS', f'{self.infakt_domain}/api/v3/bank_accounts', entity_model=InfaktBankAccountEntity, response_model=InfaktBankAccountsResponse, entity_details_model=InfaktBankAccountEntityDetails),
-      await self.download_listed_data('CLIENTS', f'{self.infakt_domain}/api/v3/clients', entity_model=InfaktClientEntity, response_model=InfaktClientsResponse, entity_details_model=InfaktClientEntityDetails)
-    ]
+    # The listed categories wait for the events to be looked through
+    if self.incremental_sync is not None: self.incremental_sync.expect_plan()
+
+    # The categories are independent, so they are fetched concurrently (sharing the client limits)
+    results: List[bool] = await asyncio.gather(
+      self.download_account_details(),
+      self.download_account_events(),
+      self.download_listed_data('PRODUCTS', f'{self.infakt_domain}/api/v3/products', entity_model=InfaktProductEntity, response_model=InfaktProductsResponse, entity_details_model=InfaktProductEntityDetails),
+      self.download_listed_data('BANK_ACCOUNTS', f'{self.infakt_domain}/api/v3/bank_accounts', entity_model=InfaktBankAccountEntity, response_model=InfaktBankAccountsResponse, entity_details_model=InfaktBankAccountEntityDetails),
+      self.download_listed_data('CLIENTS', f'{self.infakt_domain}/api/v3/clients', entity_model=InfaktClientEntity, response_model=InfaktClientsResponse, entity_details_model=InfaktClientEntityDetails)
+    )
     return all(results)
\ No newline at end of file
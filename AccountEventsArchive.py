@@ -0,0 +1,89 @@
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+from helpers import dump_to_file, remove_file
+from JsonSerializer import json_serializer
+from models.InfaktAccountEvents import InfaktAccountEvent, InfaktAccountEventsIgnoreFields
+
+# Append-only archive of the account events, kept in monthly JSON lines segments (YYYY-MM.jsonl)
+# Every line is a compact event, the lines are sorted by the time they were performed at
+class AccountEventsArchive():
+  def __init__(self, logger: logging.Logger, root_path: str = 'data/account/events', legacy_path: str = 'data/account/events.json'):
+    self.logger = logger
+    self.root_path = root_path
+    self.legacy_path = legacy_path
+
+    if not os.path.exists(self.root_path): os.mkdir(self.root_path)
+
+  def segment_path(self, segment: str) -> str:
+    return f'{self.root_path}/{segment}.jsonl'
+
+  def segments(self) -> List[str]:
+    return sorted(file_name[:-len('.jsonl')] for file_name in os.listdir(self.root_path) if file_name.endswith('.jsonl'))
+
+  @staticmethod
+  def line_key(line: bytes) -> Tuple[str, int]:
+    event = json.loads(line)
+    return event['performed_at'], event['id']
+
+  def read_segment(self, segment: str) -> List[bytes]:
+    path: str = self.segment_path(segment)
+    if not os.path.exists(path):
+      return []
+    with open(path, 'rb') as file:
+      return [line for line in file.read().split(b'\n') if len(line) > 0]
+
+  def latest_performed_at(self) -> Optional[str]:
+    # The newest stored event closes the newest segment
+    for segment in reversed(self.segments()):
+      lines: List[bytes] = self.read_segment(segment)
+      if len(lines) > 0:
+        return self.line_key(lines[-1])[0]
+    return None
+
+  def write_segment(self, segment: str, lines: List[Tuple[Tuple[str, int], bytes]]):
+    lines.sort(key=lambda line: line[0])
+    dump_to_file(self.segment_path(segment), b''.join(line + b'\n' for _, line in lines))
+
+  def add_lines(self, new_lines: List[Tuple[Tuple[str, int], bytes]]) -> int:
+    # Only the segments receiving new events are read and written again
+    segment_lines: Dict[str, List[Tuple[Tuple[str, int], bytes]]] = {}
+    for key, line in new_lines:
+      segment_lines.setdefault(key[0][:7], []).append((key, line))
+
+    added_count: int = 0
+    for segment, lines in segment_lines.items():
+      stored_lines: List[Tuple[Tuple[str, int], bytes]] = [(self.line_key(line), line) for line in self.read_segment(segment)]
+      known_ids: Set[int] = { key[1] for key, _ in stored_lines }
+      for key, line in lines:
+        if key[1] in known_ids:
+          continue # Already archived (or listed twice due to shifted pages)
+        known_ids.add(key[1])
+        stored_lines.append((key, line))
+        added_count += 1
+      if len(stored_lines) > 0:
+        self.write_segment(segment, stored_lines)
+    return added_count
+
+  def add(self, events: List[InfaktAccountEvent]) -> int:
+    new_lines: List[Tuple[Tuple[str, int], bytes]] = []
+    for event in events:
+      line: bytes = json_serializer.dump(event, exclude=InfaktAccountEventsIgnoreFields, indent=None)
+      new_lines.append((self.line_key(line), line))
+    return self.add_lines(new_lines)
+
+  def migrate(self):
+    # Splits the single events file of the previous layout into the segments
+    if not os.path.exists(self.legacy_path):
+      return
+    with open(self.legacy_path, 'rb') as file:
+      legacy_events = json.load(file)
+    new_lines: List[Tuple[Tuple[str, int], bytes]] = []
+    for event in legacy_events:
+      line: bytes = json.dumps(event, ensure_ascii=False, separators=(',', ':')).encode()
+      new_lines.append((self.line_key(line), line))
+    added_count: int = self.add_lines(new_lines)
+    remove_file(self.legacy_path)
+    self.logger.info('Moved %d account events into the monthly segments', added_count)
@@ -1,106 +1,73 @@
-import re
+import asyncio
 import logging
 import os
-import time
-import requests
-from typing import List, Dict, Optional
-from pydantic import TypeAdapter
+from typing import List, Optional
 from pypaperless import Paperless
 
-from helpers import Paginator, dump_to_file
+from helpers import details_in_list
+from InfaktClient import InfaktClient
+from IncrementalSync import IncrementalSync
+from SyncState import SyncState, SyncStateEntity
+from ListedDataDownloader import ListedDataDownloader
+from models.InfaktAccounting import InfaktAccountingEntityStatus
 from models.InfaktAccounting import InfaktSAFV7Entity, InfaktSAFV7Response, InfaktSAFV7EntityDetails
 from models.InfaktAccounting import InfaktVATEUEntity, InfaktVATEUResponse, InfaktVATEUEntityDetails
 from models.InfaktAccounting import InfaktBookEntity, InfaktBookResponse, InfaktBookEntityDetails
 from models.InfaktAccounting import InfaktIncomeTaxEntity, InfaktIncomeTaxResponse, InfaktIncomeTaxEntityDetails
 from models.InfaktAccounting import InfaktInsuranceResponse, InfaktInsuranceEntity, InfaktInsuranceEntityDetails
 
+# Periods in these states are closed - their details are not fetched again unless the listed markers change
+SETTLED_STATUSES = [InfaktAccountingEntityStatus.PAID, InfaktAccountingEntityStatus.SENT]
+
 class AccountingDownloader():
-  def __init__(self, logger: logging.Logger, infakt_session: requests.Session, infakt_domain: str, paperless: Optional[Paperless]):
+  def __init__(self, logger: logging.Logger, infakt_client: InfaktClient, infakt_domain: str, paperless: Optional[Paperless], details_concurrency: int = 8, incremental_sync: Optional[IncrementalSync] = None, sync_state: Optional[SyncState] = None):
     self.logger = logger
-    self.infakt_session = infakt_session
+    self.infakt_client = infakt_client
     self.infakt_domain = infakt_domain
     self.paperless = paperless
+    self.details_concurrency = details_concurrency
+    self.incremental_sync = incremental_sync
+    self.sync_state = sync_state
 
     # Create the required folder
     if not os.path.exists('data/accounting'): os.mkdir('data/accounting')
 
-  async def download_accounting_data(self, category: str, base_endpoint_url: str, response_model, entity_model, entity_details_model) -> bool:
-    dir_path: str = f'data/accounting/{category}'
-    try:
-      if not os.path.exists(dir_path): os.mkdir(dir_path)
-      if not os.path.exists(f'{dir_path}/details'): os.mkdir(f'{dir_path}/details')
-    except Exception as e:
-      self.logger.error('Failed to create directories required for accounting data handling - %s', category)
-      return False
-    
-    try:
-      all_entities = []
-      for data_result in Paginator(self.infakt_session, f'{base_endpoint_url}.json'):
-        parsed_data = response_model.model_validate(data_result.json())
-        if len(parsed_data.entities) == 0:
-          break
-        all_entities.extend(parsed_data.entities)
-
-      # Sort the data in ascending order
-      all_entities.sort(key=lambda x: x.period)
+  async def download_accounting_data(self, category: str, base_endpoint_url: str, response_model, entity_model, entity_details_model, details_from_list: Optional[bool] = None) -> bool:
+    # Detail requests are skipped when the listed entities carry all the fields (detected from the models unless set)
+    if details_from_list is None: details_from_list = details_in_list(entity_model, entity_details_model)
 
-      # Save the entities list
-      dump_to_file(f'{dir_path}/list.json', TypeAdapter(List[entity_model]).dump_json(all_entities, indent=2, exclude_none=True))
-  
-      entity_id_regex = re.compile(r'\b(\d+)\.')
-      archived_entities_id: Dict[int, str] = { int(result.group(1)): x for x in os.listdir(f'{dir_path}/details') if (result := entity_id_regex.search(x)) is not None }
+    force_refresh: bool = self.incremental_sync is not None and self.incremental_sync.force_full_sync
+    frozen_count: int = 0
 
-      for entity in all_entities:
-        attempt: int = 0
-        while True:
-          attempt += 1
-          if attempt > 3:
-            raise Exception('Exceeded maximum fetch attempts')
+    def select_period(entity, entity_hash: str, archived: bool, known_entity: Optional[SyncStateEntity]) -> Optional[bool]:
+      nonlocal frozen_count
+      markers_changed: bool = known_entity is None or known_entity.updated_marker != entity_hash
 
-          entity_details_result = self.infakt_session.get(f'{base_endpoint_url}/{entity.id}.json', headers={
-            "accept": "application/json"
-          })
-          if entity_details_result.status_code == 200:
-            break # Fetched successfully
-          elif entity_details_result.status_code == 429: # Ratelimited
-            retryAfter = entity_details_result.headers['Retry-After']
-            if retryAfter is not None:
-              self.logger.warning(f'Rate limited - waiting {retryAfter} seconds')
-              time.sleep(retryAfter)
-          else:
-            self.logger.warning(f'Received {entity_details_result.status_code} error - retrying in 1s')
-            time.sleep(1)
+      # Settled periods do not change as long as their listed markers (status, correction counter, payments, ...) stay the same
+      if not details_from_list and archived and not markers_changed and not force_refresh and getattr(entity, 'status', None) in SETTLED_STATUSES:
+        frozen_count += 1
+        return None
 
-        target_name: str = f'{entity.period} {entity.id}'
-        
-        # Restore the path if already exists
-        if entity.id in archived_entities_id and archived_entities_id[entity.id] != f'{target_name}.json':
-          os.rename(f'{dir_path}/details/{archived_entities_id[entity.id]}', f'{dir_path}/details/{target_name}.json')
+      # Skip the archived entities which were not changed since the last synchronization
+      if details_from_list or markers_changed or self.incremental_sync is None or self.incremental_sync.should_fetch_details(category, entity.id, archived):
+        return True
+      return None
 
-        parsed_entity_details = entity_details_model.model_validate(entity_details_result.json())
-        
-        # Save entity to file
-        dump_to_file(f'{dir_path}/details/{target_name}.json', parsed_entity_details.model_dump_json(indent=2, exclude_none=True))
-       
-      # Adjust deleted data names
-      deleted_entities_id = archived_entities_id.keys() - [entity.id for entity in all_entities]
-      for deleted_entity_id in deleted_entities_id:
-        target_name = f'(DELETED) {deleted_entity_id}'
-        if archived_entities_id[deleted_entity_id] != target_name:
-          os.rename(f'{dir_path}/details/{archived_entities_id[deleted_entity_id]}', f'{dir_path}/details/{target_name}.json')
+    listed_data = ListedDataDownloader(self.logger, self.infakt_client, category, f'data/accounting/{category}', base_endpoint_url, response_model, entity_details_model, 'accounting data', details_concurrency=self.details_concurrency, incremental_sync=self.incremental_sync, sync_state=self.sync_state, details_from_list=details_from_list,
+      target_name=lambda entity: f'{entity.period} {entity.id}', sort_key=lambda entity: entity.period, period=lambda entity: str(entity.period), select=select_period)
+    result: bool = await listed_data.process()
 
-      self.logger.info('Finished fetching accounting data - %s', category)
-      return True
-    except Exception as e:
-      self.logger.error('Failed to handle accounting data - %s %s %s', category, type(e), e)
-      return False
+    if frozen_count > 0:
+      self.logger.info('Skipped %d settled periods - %s', frozen_count, category)
+    return result
 
   async def process(self) -> bool:
-    results: List[bool] = [
-      await self.download_accounting_data('JPK', f'{self.infakt_domain}/api/v3/saf_v7_files', response_model=InfaktSAFV7Response, entity_model=InfaktSAFV7Entity, entity_details_model=InfaktSAFV7EntityDetails),
-      await self.download_accounting_data('VAT_EU', f'{self.infakt_domain}/api/v3/vat_eu_taxes', response_model=InfaktVATEUResponse, entity_model=InfaktVATEUEntity, entity_details_model=InfaktVATEUEntityDetails),
-      await self.download_accounting_data('REV_TAX', f'{self.infakt_domain}/api/v3/income_taxes', response_model=InfaktIncomeTaxResponse, entity_model=InfaktIncomeTaxEntity, entity_details_model=InfaktIncomeTaxEntityDetails),
-      await self.download_accounting_data('KPiR', f'{self.infakt_domain}/api/v3/books', response_model=InfaktBookResponse, entity_model=InfaktBookEntity, entity_details_model=InfaktBookEntityDetails),
-      await self.download_accounting_data('INSUR', f'{self.infakt_domain}/api/v3/insurance_fees', response_model=InfaktInsuranceResponse, entity_model=InfaktInsuranceEntity, entity_details_model=InfaktInsuranceEntityDetails)
-    ]
+    # The categories are independent, so they are fetched concurrently (sharing the client limits)
+    results: List[bool] = await asyncio.gather(
+      self.download_accounting_data('JPK', f'{self.infakt_domain}/api/v3/saf_v7_files', response_model=InfaktSAFV7Response, entity_model=InfaktSAFV7Entity, entity_details_model=InfaktSAFV7EntityDetails),
+      self.download_accounting_data('VAT_EU', f'{self.infakt_domain}/api/v3/vat_eu_taxes', response_model=InfaktVATEUResponse, entity_model=InfaktVATEUEntity, entity_details_model=InfaktVATEUEntityDetails),
+      self.download_accounting_data('REV_TAX', f'{self.infakt_domain}/api/v3/income_taxes', response_model=InfaktIncomeTaxResponse, entity_model=InfaktIncomeTaxEntity, entity_details_model=InfaktIncomeTaxEntityDetails),
+      self.download_accounting_data('KPiR', f'{self.infakt_domain}/api/v3/books', response_model=InfaktBookResponse, entity_model=InfaktBookEntity, entity_details_model=InfaktBookEntityDetails),
+      self.download_accounting_data('INSUR', f'{self.infakt_domain}/api/v3/insurance_fees', response_model=InfaktInsuranceResponse, entity_model=InfaktInsuranceEntity, entity_details_model=InfaktInsuranceEntityDetails)
+    )
     return all(results)
\ No newline at end of file
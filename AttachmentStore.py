@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import os
+import tempfile
+from typing import Dict, Optional
+
+from InfaktClient import InfaktClient
+from SyncState import SyncState
+from helpers import write_journal
+from models.InfaktCosts import InfaktCostAttachment
+
+# Content-addressed store of the cost attachments - every distinct file is downloaded and kept only once
+class AttachmentStore():
+  def __init__(self, logger: logging.Logger, infakt_client: InfaktClient, sync_state: SyncState, root_path: str = 'data/attachments'):
+    self.logger = logger
+    self.infakt_client = infakt_client
+    self.sync_state = sync_state
+    self.root_path = root_path
+    self.in_progress: Dict[str, asyncio.Future] = {}
+
+    # Statistics
+    self.downloaded: int = 0
+    self.duplicates: int = 0
+
+    os.makedirs(f'{self.root_path}/objects', exist_ok=True)
+
+  def object_path(self, content_hash: str, file_name: str) -> str:
+    extension: str = os.path.splitext(file_name)[1].lower()
+    return f'{self.root_path}/objects/{content_hash[:2]}/{content_hash}{extension}'
+
+  def get_path(self, document_scan_uuid: str) -> Optional[str]:
+    known_attachment = self.sync_state.get_attachment(document_scan_uuid)
+    if known_attachment is None:
+      return None
+    path: str = self.object_path(known_attachment.content_hash, known_attachment.file_name)
+    return path if os.path.exists(path) else None
+
+  async def fetch(self, attachment: InfaktCostAttachment) -> str:
+    # The download link changes on every call, so the attachments are recognized by the scan UUID
+    if (path := self.get_path(attachment.document_scan_uuid)) is not None:
+      return path
+
+    # Join an already running download of the same scan
+    if attachment.document_scan_uuid in self.in_progress:
+      return await self.in_progress[attachment.document_scan_uuid]
+
+    future: asyncio.Future = asyncio.get_running_loop().create_future()
+    self.in_progress[attachment.document_scan_uuid] = future
+    try:
+      path = await self.download(attachment)
+      future.set_result(path)
+      return path
+    except Exception as e:
+      future.set_exception(e)
+      future.exception() # Mark as retrieved when nobody else is waiting
+      raise
+    finally:
+      del self.in_progress[attachment.document_scan_uuid]
+
+  async def download(self, attachment: InfaktCostAttachment) -> str:
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=self.root_path, suffix='.tmp')
+    os.close(file_descriptor)
+    try:
+      content_hash, size = await self.infakt_client.download_to_file(attachment.download_url, temporary_path)
+
+      path: str = self.object_path(content_hash, attachment.file_name)
+      if os.path.exists(path): # Same bytes stored under a different scan
+        self.duplicates += 1
+      else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temporary_path, path)
+        write_journal.record(path)
+        self.downloaded += 1
+    finally:
+      if os.path.exists(temporary_path): os.remove(temporary_path)
+
+    self.sync_state.update_attachment(attachment.document_scan_uuid, content_hash, attachment.file_name, size)
+    self.sync_state.commit()
+    return path
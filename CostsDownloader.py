@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import os
+from typing import List, Dict, Set, Optional
+from pypaperless import Paperless
+
+from helpers import Paginator, dump_to_file, rename_directory, link_file, ordered_map, UUID_REGEX
+from InfaktClient import InfaktClient
+from JsonSerializer import json_serializer
+from IncrementalSync import IncrementalSync
+from SyncState import SyncState, content_hash
+from DetailsManifest import DetailsManifest
+from AttachmentStore import AttachmentStore
+from models.InfaktCosts import InfaktCostsResponse, InfaktCostEntity, InfaktCostEntityDetailed, InfaktCostStatusSymbol
+
+# The download links change on every call
+InfaktCostDetailsIgnoreFields = {
+  'attachments': { '__all__': { 'file_url', 'download_url' } }
+}
+
+class CostsDownloader():
+  def __init__(self, logger: logging.Logger, infakt_client: InfaktClient, infakt_domain: str, paperless: Optional[Paperless], attachment_store: AttachmentStore, details_concurrency: int = 8, incremental_sync: Optional[IncrementalSync] = None, sync_state: Optional[SyncState] = None):
+    self.logger = logger
+    self.infakt_client = infakt_client
+    self.infakt_domain = infakt_domain
+    self.paperless = paperless
+    self.attachment_store = attachment_store
+    self.details_concurrency = details_concurrency
+    self.incremental_sync = incremental_sync
+    self.sync_state = sync_state
+
+    # Create the required folder
+    if not os.path.exists('data/costs'): os.mkdir('data/costs')
+
+  @staticmethod
+  def get_directory_name(entity: InfaktCostEntity) -> str:
+    directory_name: str = f'{entity.issue_date} - {entity.uuid}'
+    if any(status.symbol == InfaktCostStatusSymbol.COST_REJECTED for status in entity.statuses):
+      directory_name += ' (REJECTED)'
+    return directory_name
+
+  async def fetch_cost_details(self, listed_entity):
+    entity, entity_hash = listed_entity
+    cost_details_result = await self.infakt_client.get(f'{self.infakt_domain}/api/v3/documents/costs/{entity.uuid}.json')
+    parsed_cost_details: InfaktCostEntityDetailed = InfaktCostEntityDetailed.model_validate_json(cost_details_result.content)
+
+    # The attachments of a cost are downloaded at once (the store skips the already known ones)
+    attachment_paths: List[str] = await asyncio.gather(*[self.attachment_store.fetch(attachment) for attachment in parsed_cost_details.attachments])
+    return entity, entity_hash, parsed_cost_details, attachment_paths
+
+  async def process(self) -> bool:
+    dir_path: str = 'data/costs'
+    try:
+      manifest = DetailsManifest(self.logger, self.sync_state, 'COSTS', dir_path, entity_id_regex=UUID_REGEX, entity_id_type=str, rename=rename_directory)
+      archived_costs_uuid: Dict[str, str] = manifest.load(rescan=self.incremental_sync is not None and self.incremental_sync.force_full_sync)
+      known_costs = self.sync_state.entities('COSTS') if self.sync_state is not None else {}
+
+      listed_costs_uuid: Set[str] = set()
+      fetched_count: int = 0
+
+      async def listed_entities():
+        nonlocal fetched_count
+        async for costs_result in Paginator(self.infakt_client, f'{self.infakt_domain}/api/v3/documents/costs.json', concurrency=self.details_concurrency):
+          parsed_costs: InfaktCostsResponse = InfaktCostsResponse.model_validate_json(costs_result.content)
+          if len(parsed_costs.entities) == 0:
+            break
+
+          # The periodic full synchronization refetches everything
+          if self.incremental_sync is not None: await self.incremental_sync.wait_planned()
+          full_sync: bool = self.incremental_sync is not None and self.incremental_sync.planned and self.incremental_sync.full_sync
+          for entity in parsed_costs.entities:
+            listed_costs_uuid.add(entity.uuid)
+            entity_content: bytes = json_serializer.dump(entity)
+            entity_hash: str = content_hash(entity_content)
+            directory_name: str = self.get_directory_name(entity)
+
+            # Move the directory if the issue date or the rejection changed
+            if entity.uuid in archived_costs_uuid and archived_costs_uuid[entity.uuid] != directory_name:
+              manifest.rename(entity.uuid, archived_costs_uuid[entity.uuid], directory_name)
+              archived_costs_uuid[entity.uuid] = directory_name
+            if not os.path.exists(f'{dir_path}/{directory_name}'): os.mkdir(f'{dir_path}/{directory_name}')
+            dump_to_file(f'{dir_path}/{directory_name}/data.json', entity_content)
+
+            # The statuses and notes are a part of the listed entity, so the details are fetched only when it changes
+            known_cost = known_costs.get(entity.uuid)
+            archived: bool = os.path.exists(f'{dir_path}/{directory_name}/detailed_data.json') and known_cost is not None
+            if full_sync or not archived or known_cost.updated_marker != entity_hash:
+              fetched_count += 1
+              yield entity, entity_hash
+
+      # Fetch the details and attachments concurrently while the pages are still arriving
+      changed_count: int = 0
+      async for entity, entity_hash, parsed_cost_details, attachment_paths in ordered_map(self.fetch_cost_details, listed_entities(), self.details_concurrency):
+        directory_name: str = self.get_directory_name(entity)
+
+        # Attachments are linked from the store to keep the layout browsable
+        if len(attachment_paths) > 0 and not os.path.exists(f'{dir_path}/{directory_name}/attachments'): os.mkdir(f'{dir_path}/{directory_name}/attachments')
+        for attachment, attachment_path in zip(parsed_cost_details.attachments, attachment_paths):
+          link_file(attachment_path, f'{dir_path}/{directory_name}/attachments/{attachment.file_name}')
+
+        cost_details_content: bytes = json_serializer.dump(parsed_cost_details, exclude=InfaktCostDetailsIgnoreFields)
+        dump_to_file(f'{dir_path}/{directory_name}/detailed_data.json', cost_details_content)
+
+        # Remember what was stored
+        if self.sync_state is not None:
+          cost_details_hash: str = content_hash(cost_details_content)
+          if self.sync_state.has_changed('COSTS', entity.uuid, cost_details_hash): changed_count += 1
+          self.sync_state.update('COSTS', entity.uuid, content_hash=cost_details_hash, file_name=directory_name, updated_marker=entity_hash)
+
+      if fetched_count != len(listed_costs_uuid):
+        self.logger.info('Fetched details of %d out of %d costs', fetched_count, len(listed_costs_uuid))
+
+      # Adjust deleted costs names
+      deleted_costs_uuid = archived_costs_uuid.keys() - listed_costs_uuid
+      for deleted_cost_uuid in deleted_costs_uuid:
+        if not archived_costs_uuid[deleted_cost_uuid].startswith('(DELETED) '):
+          target_name: str = f'(DELETED) {archived_costs_uuid[deleted_cost_uuid]}'
+          manifest.rename(deleted_cost_uuid, archived_costs_uuid[deleted_cost_uuid], target_name)
+
+      if self.sync_state is not None:
+        manifest.save()
+        self.sync_state.commit()
+        self.logger.info('%d costs changed since the last fetch', changed_count)
+
+      self.logger.info('Finished fetching costs (%d attachments downloaded, %d duplicates)', self.attachment_store.downloaded, self.attachment_store.duplicates)
+      return True
+    except Exception as e:
+      self.logger.error('Failed to handle costs - %s %s', type(e), e)
+      return False
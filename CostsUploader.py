@@ -1,19 +1,85 @@
+import asyncio
 import logging
-import time
-import requests
 from pypaperless import Paperless
-from typing import Optional
-from io import BytesIO
+from typing import Optional, List
 
+from InfaktClient import InfaktClient
+from PaperlessMetadata import PaperlessMetadata
+from helpers import ordered_map
 from models.InfaktUpload import InfaktUploadResponse, InfaktUploadEntity
 
 # Syncing the documents from Paperless-ngx to InFakt
 class CostsUploader():
-  def __init__(self, logger: logging.Logger, infakt_session: requests.Session, infakt_domain: str, paperless: Optional[Paperless]):
+  def __init__(self, logger: logging.Logger, infakt_client: InfaktClient, infakt_domain: str, paperless: Optional[Paperless], paperless_metadata: Optional[PaperlessMetadata] = None, upload_tag_name: str = 'TO UPLOAD', scan_uuid_field_name: str = 'InFakt Scan UUID', upload_batch_size: int = 10, upload_concurrency: int = 4):
     self.logger = logger
-    self.infakt_session = infakt_session
+    self.infakt_client = infakt_client
     self.infakt_domain = infakt_domain
     self.paperless = paperless
+    self.paperless_metadata = paperless_metadata
+    self.upload_tag_name = upload_tag_name
+    self.scan_uuid_field_name = scan_uuid_field_name
+    self.upload_batch_size = upload_batch_size
+    self.upload_concurrency = upload_concurrency
+
+  async def download_document(self, document):
+    try:
+      self.logger.info('Downloading %s (ID: %d) from Paperless', document.original_file_name, document.id)
+
+      # Fetch the document content (binary source)
+      return document, await document.get_download()
+    except Exception as e:
+      self.logger.error('Failed to download the invoice %d - %s %s', document.id, type(e), e)
+      return document, None
+
+  async def upload_batch(self, batch) -> bool:
+    # Upload all the files of the batch within a single request
+    try:
+      self.logger.info('Uploading %d invoices to InFakt (IDs: %s)', len(batch), ', '.join(str(document.id) for document, _ in batch))
+      upload_result = await self.infakt_client.post(
+        f'{self.infakt_domain}/api/v3/documents/costs/upload.json',
+        files=[
+          (
+            "uploads[]",
+            (document_content.disposition_filename, document_content.content, 'application/octet-stream')
+          )
+          for _, document_content in batch
+        ]
+      )
+
+      parsed_upload_result: InfaktUploadResponse = InfaktUploadResponse.model_validate_json(upload_result.content)
+      if len(parsed_upload_result.entities) != len(batch):
+        raise Exception('Incorrect amount of result entities')
+    except Exception as e:
+      self.logger.error('Failed to upload the invoices %s - %s %s', ', '.join(str(document.id) for document, _ in batch), type(e), e)
+      return False
+
+    # The entities are returned in the order of the uploaded files
+    # The scan UUID differs for every document, so each one gets all its changes applied with a single update
+    results: List[bool] = await asyncio.gather(*[
+      self.update_document(document, uploaded_document_data)
+      for (document, _), uploaded_document_data in zip(batch, parsed_upload_result.entities)
+    ])
+    return all(results)
+
+  async def update_document(self, document, uploaded_document_data: InfaktUploadEntity) -> bool:
+    try:
+      if not uploaded_document_data.success:
+        raise Exception(f'InFakt rejected the file {uploaded_document_data.name}')
+
+      # Add the Document Scan UUID field
+      doc_uuid_field_value = self.infakt_scan_uuid_field.draft_value(uploaded_document_data.document_scan_uuid)
+      document.custom_fields += doc_uuid_field_value
+
+      # Remove the TO UPLOAD tag
+      document.tags.remove(self.to_upload_infakt_tag.id)
+
+      update_result: bool = await document.update()
+      if not update_result:
+        raise Exception("Failed to update the document")
+      return True
+    except Exception as e:
+      self.logger.error('Failed to upload the invoice %d - %s %s', document.id, type(e), e)
+      return False
 
   async def process(self) -> bool:
     if self.paperless is None:
@@ -23,65 +89,29 @@ class CostsUploader():
     try:
       all_success: bool = True
 
-      # TODO: Custom ids
-      to_upload_infakt_tag = await self.paperless.tags(6) # Fetch the TO UPLOAD tag
-      infakt_scan_uuid_field = await self.paperless.custom_fields(3) # Custom field to store the document scan UUID
-      async for document in self.paperless.documents.search(f'tag:"{to_upload_infakt_tag.name}"'): # Look up all the documents
-        try:
-          self.logger.info('Uploading %s (ID: %d) to InFakt', document.original_file_name, document.id)
-
-          # Fetch the document content (binary source)
-          document_content = await document.get_download()
-
-          attempt: int = 0
-          while True:
-            attempt += 1
-            if attempt > 3:
-              raise Exception('Exceeded maximum fetch attempts')
-
-            upload_result = self.infakt_session.post(
-              'https://api.infakt.pl/api/v3/documents/costs/upload.json',
-              data={},
-              files=[
-                (
-                  "uploads[]",
-                  (document_content.disposition_filename, BytesIO(document_content.content), 'application/octet-stream')
-                )
-              ]
-            )
-            if upload_result.status_code == 201:
-              break # Fetched uploaded
-            elif upload_result.status_code == 429: # Ratelimited
-              retryAfter = upload_result.headers['Retry-After']
-              if retryAfter is not None:
-                self.logger.warning(f'Rate limited - waiting {retryAfter} seconds')
-                time.sleep(retryAfter)
-            else:
-              self.logger.warning(f'Received {upload_result.status_code} error - retrying in 1s')
-              time.sleep(1)
-
-          parsed_upload_result: InfaktUploadResponse = InfaktUploadResponse.model_validate(upload_result.json())
-          if len(parsed_upload_result.entities) != 1:
-            raise Exception('Incorrect amount of result entities')
-          
-          uploaded_document_data: InfaktUploadEntity = parsed_upload_result.entities[0]
-
-          # Add the Document Scan UUID field
-          doc_uuid_field_value = infakt_scan_uuid_field.draft_value(uploaded_document_data.document_scan_uuid)
-          document.custom_fields += doc_uuid_field_value
-
-          # Remove the TO UPLOAD tag
-          document.tags.remove(to_upload_infakt_tag.id)
-
-          update_result: bool = await document.update()
-          if not update_result:
-            raise Exception("Failed to update the document")
-
-        except Exception as e:
-          self.logger.error('Failed to upload the invoice - %s %s', type(e), e)
-          all_success = False
+      self.to_upload_infakt_tag = await self.paperless_metadata.tag(self.upload_tag_name) # Fetch the TO UPLOAD tag
+      self.infakt_scan_uuid_field = await self.paperless_metadata.custom_field(self.scan_uuid_field_name) # Custom field to store the document scan UUID
+
+      async def downloaded_batches():
+        nonlocal all_success
+        batch = []
+        # Look up all the documents and download them concurrently
+        async for document, document_content in ordered_map(self.download_document, self.paperless.documents.search(f'tag:"{self.to_upload_infakt_tag.name}"'), self.upload_concurrency):
+          if document_content is None:
+            all_success = False
+            continue
+          batch.append((document, document_content))
+          if len(batch) >= self.upload_batch_size:
+            yield batch
+            batch = []
+        if len(batch) > 0:
+          yield batch
+
+      # Batches are uploaded while the next documents are still being downloaded
+      async for batch_success in ordered_map(self.upload_batch, downloaded_batches(), self.upload_concurrency):
+        all_success = all_success and batch_success
 
       return all_success
     except Exception as e:
       self.logger.error('Failed to upload the invoices - %s %s', type(e), e)
-      return False
\ No newline at end of file
+      return False
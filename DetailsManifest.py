@@ -0,0 +1,70 @@
+import logging
+import os
+import re
+from typing import Callable, Dict, Optional
+
+from SyncState import SyncState
+from helpers import rename_file
+
+# Index of the archived files of a category (id -> file name, including the period and the deletion marker)
+# Kept in the sync state and updated as the files are written, the directory is scanned only to bootstrap it
+# or when it was changed outside of the sync (e.g. the data repo was cloned again or reset)
+class DetailsManifest():
+  def __init__(self, logger: logging.Logger, sync_state: Optional[SyncState], category: str, dir_path: str, entity_id_regex: re.Pattern = re.compile(r'\b(\d+)\.'), entity_id_type: Callable = int, rename: Callable[[str, str], None] = rename_file):
+    self.logger = logger
+    self.sync_state = sync_state
+    self.category = category
+    self.dir_path = dir_path
+    self.entity_id_regex = entity_id_regex
+    self.entity_id_type = entity_id_type
+    self.rename_path = rename
+
+  def scan(self) -> Dict:
+    return { self.entity_id_type(result.group(1) if result.groups() else result.group(0)): x for x in os.listdir(self.dir_path) if (result := self.entity_id_regex.search(x)) is not None }
+
+  def directory_stamp(self) -> str:
+    # Adding, removing or renaming an entry updates the modification time of the directory
+    return str(os.stat(self.dir_path).st_mtime_ns)
+
+  def load(self, rescan: bool = False) -> Dict:
+    if self.sync_state is None:
+      return self.scan()
+
+    stored_stamp: Optional[str] = self.sync_state.get_metadata(f'manifest:{self.category}')
+    if stored_stamp is not None and stored_stamp != self.directory_stamp():
+      self.logger.info('Archived files were changed outside of the sync - rescanning - %s', self.category)
+      rescan = True
+
+    if rescan or stored_stamp is None:
+      # First run with the manifest (or a forced refresh) - take over the names of the files on the disk
+      archived_entities_id: Dict = self.scan()
+      for entity_id, file_name in archived_entities_id.items():
+        self.sync_state.update(self.category, entity_id, file_name=file_name, fetched=False)
+      for entity_id in self.sync_state.file_names(self.category).keys() - { str(entity_id) for entity_id in archived_entities_id.keys() }:
+        self.sync_state.clear_file_name(self.category, entity_id) # Missing on the disk
+      self.sync_state.set_metadata(f'manifest:{self.category}', self.directory_stamp())
+      self.sync_state.commit()
+      self.logger.info('Indexed %d archived files - %s', len(archived_entities_id), self.category)
+      return archived_entities_id
+
+    return { self.entity_id_type(entity_id): file_name for entity_id, file_name in self.sync_state.file_names(self.category).items() }
+
+  def rename(self, entity_id, source_name: str, target_name: str, fetched: bool = False) -> bool:
+    # Stored right away, so an interrupted run does not leave the manifest pointing at the old name
+    if not os.path.exists(f'{self.dir_path}/{source_name}'):
+      self.logger.warning('Archived file %s is missing - %s', source_name, self.category)
+      if self.sync_state is not None:
+        self.sync_state.clear_file_name(self.category, entity_id)
+        self.sync_state.commit()
+      return False
+
+    self.rename_path(f'{self.dir_path}/{source_name}', f'{self.dir_path}/{target_name}')
+    if self.sync_state is not None:
+      self.sync_state.update(self.category, entity_id, file_name=target_name, fetched=fetched)
+      self.sync_state.commit()
+    return True
+
+  def save(self):
+    # Called once all the files of a run are written (committed along with the entities)
+    if self.sync_state is not None:
+      self.sync_state.set_metadata(f'manifest:{self.category}', self.directory_stamp())
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import re
+from datetime import datetime, timedelta
+from typing import List, Dict, Set, Optional
+
+from SyncState import SyncState
+from models.InfaktAccountEvents import InfaktAccountEvent, InfaktAccountEventActionSymbol
+
+# Events that do not change any of the archived entities (account details are always refetched)
+IGNORED_ACTIONS: Set[InfaktAccountEventActionSymbol] = {
+  InfaktAccountEventActionSymbol.LOGIN,
+  InfaktAccountEventActionSymbol.USER_PASSWORD_CHANGED,
+  InfaktAccountEventActionSymbol.IFE_PREVIEW,
+  InfaktAccountEventActionSymbol.PRINT_DECLARATION_PREVIEW,
+  InfaktAccountEventActionSymbol.CHANGE_COMPANY_ADDRESS_SECTION,
+  InfaktAccountEventActionSymbol.CHANGE_PIT_TYPE
+}
+
+# Events that point to a single entity of a known category
+ACTION_CATEGORIES: Dict[InfaktAccountEventActionSymbol, str] = {
+  InfaktAccountEventActionSymbol.CREATE_CLIENT: 'CLIENTS',
+  InfaktAccountEventActionSymbol.UPDATE_CLIENT: 'CLIENTS',
+  InfaktAccountEventActionSymbol.CREATE_PRODUCT: 'PRODUCTS',
+  InfaktAccountEventActionSymbol.ESAF_XML: 'JPK',
+  InfaktAccountEventActionSymbol.ESAF_SUBMISSION: 'JPK',
+  InfaktAccountEventActionSymbol.UNLOCK_SAF_SUBMISSION: 'JPK',
+  InfaktAccountEventActionSymbol.APPROVE_SAF: 'JPK',
+  InfaktAccountEventActionSymbol.SAF_V7_REFUNDS: 'JPK',
+  InfaktAccountEventActionSymbol.SAF_V7_RESET_STATUS: 'JPK',
+  InfaktAccountEventActionSymbol.SAF_V7_DESTROY_CORRECTION_WITHOUT_RESET: 'JPK',
+  InfaktAccountEventActionSymbol.SAF_V7_DESTROY_CORRECTION: 'JPK',
+  InfaktAccountEventActionSymbol.IFE_SUBMISSION: 'INSUR',
+  InfaktAccountEventActionSymbol.IFE_XML: 'INSUR',
+  InfaktAccountEventActionSymbol.IFE_FILE_RESET_STATUS: 'INSUR',
+  InfaktAccountEventActionSymbol.DESTROY_IFE_CORRECTION: 'INSUR',
+  InfaktAccountEventActionSymbol.DECLARATION_SUBMISSION: 'REV_TAX',
+  InfaktAccountEventActionSymbol.APPROVE_DECLARATION: 'REV_TAX',
+  InfaktAccountEventActionSymbol.PAID_DECLARATION: 'REV_TAX',
+  InfaktAccountEventActionSymbol.PRINT_DECLARATION: 'REV_TAX',
+  InfaktAccountEventActionSymbol.DISCARD_DECLARATION: 'REV_TAX'
+}
+
+# Events that change a whole set of categories at once
+ACTION_FULL_CATEGORIES: Dict[InfaktAccountEventActionSymbol, Set[str]] = {
+  InfaktAccountEventActionSymbol.MONTH_COMPLETED: {'KPiR', 'JPK', 'VAT_EU', 'REV_TAX'},
+  InfaktAccountEventActionSymbol.ADD_HOLIDAYS: {'INSUR'},
+  InfaktAccountEventActionSymbol.AUTOMATIC_SUSPENSION_ON_START: {'INSUR'},
+  InfaktAccountEventActionSymbol.BANKING_CREATE_INTEGRATION: {'BANK_ACCOUNTS'},
+  InfaktAccountEventActionSymbol.BANKING_AUTO_DESTROY_INTEGRATION: {'BANK_ACCOUNTS'},
+  InfaktAccountEventActionSymbol.BANKING_EXPIRE_INTEGRATION: {'BANK_ACCOUNTS'},
+  InfaktAccountEventActionSymbol.BANKING_REFRESH_INTEGRATION: {'BANK_ACCOUNTS'},
+  InfaktAccountEventActionSymbol.BANKING_DESTROY_INTEGRATION: {'BANK_ACCOUNTS'}
+}
+
+# Generic events (create, update, paid, ...) are resolved by the subject type (normalized to lowercase letters and digits)
+SUBJECT_TYPE_CATEGORIES: Dict[str, str] = {
+  'client': 'CLIENTS',
+  'product': 'PRODUCTS',
+  'bankaccount': 'BANK_ACCOUNTS',
+  'safv7file': 'JPK',
+  'saffile': 'JPK',
+  'vateutax': 'VAT_EU',
+  'incometax': 'REV_TAX',
+  'book': 'KPiR',
+  'insurancefee': 'INSUR',
+  'invoice': 'INVOICES',
+  'correctiveinvoice': 'CORRECTIVE_INVOICES',
+  'cost': 'COSTS',
+  'documentscan': 'COSTS'
+}
+
+# Events are recorded with a delay, so the already seen ones are looked through again
+WATERMARK_OVERLAP = timedelta(minutes=10)
+
+class IncrementalSync():
+  def __init__(self, logger: logging.Logger, sync_state: SyncState, full_sync_interval: timedelta = timedelta(days=7), force_full_sync: bool = False):
+    self.logger = logger
+    self.sync_state = sync_state
+    self.full_sync_interval = full_sync_interval
+    self.force_full_sync = force_full_sync
+
+    self.last_event_at: Optional[datetime] = None
+    self.last_full_sync_at: Optional[datetime] = None
+    self.load()
+
+    # Filled in by plan()
+    self.planned: bool = False
+    self.full_sync: bool = True
+    self.next_event_at: Optional[datetime] = self.last_event_at
+    self.changed_ids: Dict[str, Set[int | str]] = {}
+    self.changed_categories: Set[str] = set()
+
+    # Released once the events are looked through (or failed to be), so the other stages can run in the meantime
+    self.planning_done: asyncio.Event = asyncio.Event()
+    self.plan_expected: bool = False
+
+  def expect_plan(self):
+    # Called before the stages start by whoever is going to look through the account events
+    self.plan_expected = True
+
+  async def wait_planned(self):
+    # Nobody looks through the events - nothing is planned, so the stages do not wait and fetch everything
+    if self.plan_expected:
+      await self.planning_done.wait()
+
+  def finish_planning(self):
+    self.planning_done.set()
+
+  def load(self):
+    last_event_at: Optional[str] = self.sync_state.get_metadata('last_event_at')
+    if last_event_at is not None: self.last_event_at = datetime.fromisoformat(last_event_at)
+    last_full_sync_at: Optional[str] = self.sync_state.get_metadata('last_full_sync_at')
+    if last_full_sync_at is not None: self.last_full_sync_at = datetime.fromisoformat(last_full_sync_at)
+
+  def save(self):
+    # Called only after a successful run, so a failed one is replayed from the same watermark
+    if self.planned and self.full_sync:
+      self.last_full_sync_at = datetime.now()
+    self.last_event_at = self.next_event_at
+    self.sync_state.set_metadata('last_event_at', self.last_event_at.isoformat() if self.last_event_at is not None else None)
+    self.sync_state.set_metadata('last_full_sync_at', self.last_full_sync_at.isoformat() if self.last_full_sync_at is not None else None)
+    self.sync_state.commit()
+
+  def mark_category(self, category: str):
+    self.changed_categories.add(category)
+
+  def mark_entity(self, category: str, entity_id: int | str):
+    self.changed_ids.setdefault(category, set()).add(entity_id)
+
+  def plan(self, events: List[InfaktAccountEvent]):
+    try:
+      self.plan_events(events)
+    finally:
+      self.finish_planning()
+
+  def plan_events(self, events: List[InfaktAccountEvent]):
+    self.planned = True
+    self.changed_ids = {}
+    self.changed_categories = set()
+    if len(events) > 0:
+      self.next_event_at = max(event.performed_at for event in events)
+
+    if self.force_full_sync or self.last_event_at is None or self.last_full_sync_at is None or datetime.now() - self.last_full_sync_at >= self.full_sync_interval:
+      self.full_sync = True
+      self.logger.info('Running a full synchronization')
+      return
+
+    self.full_sync = False
+    threshold: datetime = self.last_event_at - WATERMARK_OVERLAP
+    new_events: List[InfaktAccountEvent] = [event for event in events if event.performed_at >= threshold]
+    for event in new_events:
+      if event.action_symbol in IGNORED_ACTIONS:
+        continue
+      elif event.action_symbol in ACTION_FULL_CATEGORIES:
+        for category in ACTION_FULL_CATEGORIES[event.action_symbol]:
+          self.mark_category(category)
+      elif event.action_symbol in ACTION_CATEGORIES:
+        self.mark_entity(ACTION_CATEGORIES[event.action_symbol], event.subject_id)
+      elif (category := SUBJECT_TYPE_CATEGORIES.get(re.sub(r'[^a-z0-9]', '', event.subject_type.lower()))) is not None:
+        self.mark_entity(category, event.subject_id)
+      else:
+        # Unknown kind of change - fall back to a full synchronization to stay safe
+        self.logger.info('Unknown event %s on %s - running a full synchronization', event.action_symbol.value, event.subject_type)
+        self.full_sync = True
+        return
+
+    self.logger.info('Running an incremental synchronization - %d new events, changed: %s', len(new_events), ', '.join(sorted(self.changed_categories | self.changed_ids.keys())) or 'nothing')
+
+  def should_fetch_details(self, category: str, entity_id: int | str, archived: bool) -> bool:
+    if not self.planned or self.full_sync or not archived:
+      return True
+    return category in self.changed_categories or entity_id in self.changed_ids.get(category, set())
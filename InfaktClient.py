@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import json
+import os
+import logging
+import aiohttp
+from typing import Optional, Dict, List, Tuple, Any
+
+from RateLimiter import RateLimiter, parse_retry_after
+
+class InfaktResponse():
+  def __init__(self, status_code: int, headers: Dict[str, str], content: bytes):
+    self.status_code = status_code
+    self.headers = headers
+    self.content = content
+
+  def json(self) -> Any:
+    return json.loads(self.content)
+
+# Shared asyncio client for the InFakt API - one pooled connection set for all the downloaders
+class InfaktClient():
+  def __init__(self, logger: logging.Logger, api_key: Optional[str], infakt_domain: str, rate_limiter: Optional[RateLimiter] = None, max_connections: int = 10, max_attempts: int = 3):
+    self.logger = logger
+    self.api_key = api_key
+    self.infakt_domain = infakt_domain
+    self.rate_limiter = rate_limiter
+    self.max_connections = max_connections
+    self.max_attempts = max_attempts
+    self.session: Optional[aiohttp.ClientSession] = None
+
+  def get_session(self) -> aiohttp.ClientSession:
+    # The session has to be created inside of the running event loop
+    if self.session is None or self.session.closed:
+      self.session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=self.max_connections),
+        timeout=aiohttp.ClientTimeout(total=300)
+      )
+    return self.session
+
+  async def close(self):
+    if self.session is not None and not self.session.closed:
+      await self.session.close()
+
+  async def request(self, method: str, url: str, expected_status: int = 200, params: Optional[Dict[str, Any]] = None, files: Optional[List[Tuple[str, Tuple[str, bytes, str]]]] = None, authorized: bool = True) -> InfaktResponse:
+    attempt: int = 0
+    while True:
+      attempt += 1
+      if attempt > self.max_attempts:
+        raise Exception('Exceeded maximum fetch attempts')
+
+      # Form data can be sent only once, so it is rebuilt on every attempt
+      data: Optional[aiohttp.FormData] = None
+      if files is not None:
+        data = aiohttp.FormData()
+        for field_name, (file_name, file_content, content_type) in files:
+          data.add_field(field_name, file_content, filename=file_name, content_type=content_type)
+
+      # The API key is sent only to the API itself and not to the attachment storage links
+      headers: Dict[str, str] = { "accept": "application/json" }
+      if authorized: headers["X-inFakt-ApiKey"] = self.api_key or ''
+
+      # Wait for the shared request budget
+      if authorized and self.rate_limiter is not None:
+        await self.rate_limiter.acquire()
+
+      try:
+        async with self.get_session().request(method, url, params=params, data=data, headers=headers) as response:
+          result = InfaktResponse(response.status, dict(response.headers), await response.read())
+      except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        self.logger.warning('Request to %s failed - %s %s - retrying in 1s', url, type(e), e)
+        await asyncio.sleep(1)
+        continue
+
+      if result.status_code == expected_status:
+        return result # Fetched successfully
+      elif result.status_code == 429: # Ratelimited
+        retry_after: float = parse_retry_after(result.headers.get('Retry-After'))
+        self.logger.warning(f'Rate limited - waiting {retry_after} seconds')
+        if authorized and self.rate_limiter is not None:
+          self.rate_limiter.block_for(retry_after) # Holds back all the other requests as well
+        else:
+          await asyncio.sleep(retry_after)
+      else:
+        self.logger.warning(f'Received {result.status_code} error - retrying in 1s')
+        await asyncio.sleep(1)
+
+  async def get(self, url: str, params: Optional[Dict[str, Any]] = None) -> InfaktResponse:
+    return await self.request('GET', url, params=params)
+
+  async def post(self, url: str, files: Optional[List[Tuple[str, Tuple[str, bytes, str]]]] = None, expected_status: int = 201) -> InfaktResponse:
+    return await self.request('POST', url, expected_status=expected_status, files=files)
+
+  async def download_to_file(self, url: str, path: str, chunk_size: int = 1024 * 1024, params: Optional[Dict[str, Any]] = None, authorized: bool = False) -> Tuple[str, int]:
+    # Streams the file to the disk in chunks, hashing it on the way - returns the SHA-256 and the size
+    attempt: int = 0
+    while True:
+      attempt += 1
+      if attempt > self.max_attempts:
+        raise Exception('Exceeded maximum download attempts')
+
+      # Files generated by the API (e.g. invoice PDFs) need the key, the attachment storage links do not
+      headers: Dict[str, str] = {}
+      if authorized:
+        headers["X-inFakt-ApiKey"] = self.api_key or ''
+        if self.rate_limiter is not None: await self.rate_limiter.acquire()
+
+      try:
+        async with self.get_session().get(url, params=params, headers=headers) as response:
+          if response.status == 200:
+            hasher = hashlib.sha256()
+            size: int = 0
+            with open(path, 'wb') as file:
+              async for chunk in response.content.iter_chunked(chunk_size):
+                hasher.update(chunk)
+                file.write(chunk)
+                size += len(chunk)
+            return hasher.hexdigest(), size
+          elif response.status == 429: # Ratelimited
+            retry_after: float = parse_retry_after(response.headers.get('Retry-After'))
+            self.logger.warning(f'Rate limited - waiting {retry_after} seconds')
+            if authorized and self.rate_limiter is not None:
+              self.rate_limiter.block_for(retry_after)
+            else:
+              await asyncio.sleep(retry_after)
+            continue
+          self.logger.warning(f'Received {response.status} error while downloading - retrying in 1s')
+      except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        self.logger.warning('Download of %s failed - %s %s - retrying in 1s', url, type(e), e)
+        if os.path.exists(path): os.remove(path)
+      await asyncio.sleep(1)
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import os
+from typing import List, Optional
+from pypaperless import Paperless
+
+from helpers import rename_file, replace_file
+from InfaktClient import InfaktClient
+from JsonSerializer import json_serializer
+from IncrementalSync import IncrementalSync
+from SyncState import SyncState, SyncStateEntity, content_hash
+from ListedDataDownloader import ListedDataDownloader
+from models.InfaktInvoices import InfaktInvoiceResponse, InfaktInvoiceEntity, InfaktInvoiceEntityDetails
+from models.InfaktInvoices import InfaktCorrectiveInvoiceResponse, InfaktCorrectiveInvoiceEntity, InfaktCorrectiveInvoiceEntityDetails
+
+class InvoicesDownloader():
+  def __init__(self, logger: logging.Logger, infakt_client: InfaktClient, infakt_domain: str, paperless: Optional[Paperless], details_concurrency: int = 8, incremental_sync: Optional[IncrementalSync] = None, sync_state: Optional[SyncState] = None):
+    self.logger = logger
+    self.infakt_client = infakt_client
+    self.infakt_domain = infakt_domain
+    self.paperless = paperless
+    self.details_concurrency = details_concurrency
+    self.incremental_sync = incremental_sync
+    self.sync_state = sync_state
+
+    # Create the required folder
+    if not os.path.exists('data/invoices'): os.mkdir('data/invoices')
+
+  async def download_pdf(self, url: str, path: str) -> bool:
+    # Streamed into a temporary file first, so a broken download never replaces the archived PDF
+    temporary_path: str = f'{path}.tmp'
+    try:
+      await self.infakt_client.download_to_file(url, temporary_path, params={ 'document_type': 'original' }, authorized=True)
+      return replace_file(temporary_path, path)
+    finally:
+      if os.path.exists(temporary_path): os.remove(temporary_path)
+
+  async def download_invoices_data(self, category: str, base_endpoint_url: str, response_model, entity_model, entity_details_model) -> bool:
+    dir_path: str = f'data/invoices/{category}'
+    try:
+      if not os.path.exists(dir_path): os.mkdir(dir_path)
+      if not os.path.exists(f'{dir_path}/pdf'): os.mkdir(f'{dir_path}/pdf')
+    except Exception as e:
+      self.logger.error('Failed to create directories required for invoices data handling - %s', category)
+      return False
+
+    pdf_count: int = 0
+
+    def select_invoice(entity, entity_hash: str, archived: bool, known_entity: Optional[SyncStateEntity]) -> Optional[bool]:
+      # Payments and the status are a part of the listed invoice, the KSeF submission comes with an account event
+      unchanged: bool = archived and known_entity is not None and known_entity.updated_marker == entity_hash
+
+      # The PDF is rendered from the invoice, so the full synchronization alone does not download it again
+      pdf_outdated: bool = not unchanged or not os.path.exists(f'{dir_path}/pdf/{entity.invoice_date} {entity.id}.pdf')
+      if pdf_outdated or (self.incremental_sync is not None and self.incremental_sync.should_fetch_details(category, entity.id, True)):
+        return pdf_outdated
+      return None
+
+    async def fetch_invoice_details(entity, pdf_outdated: bool) -> bytes:
+      nonlocal pdf_count
+      pdf_path: str = f'{dir_path}/pdf/{entity.invoice_date} {entity.id}.pdf'
+      if pdf_outdated:
+        # The details and the PDF are fetched at once
+        entity_details_result, _ = await asyncio.gather(
+          self.infakt_client.get(f'{base_endpoint_url}/{entity.id}.json'),
+          self.download_pdf(f'{base_endpoint_url}/{entity.id}/pdf.json', pdf_path)
+        )
+        pdf_count += 1
+      else:
+        entity_details_result = await self.infakt_client.get(f'{base_endpoint_url}/{entity.id}.json')
+      entity_details_content: bytes = json_serializer.dump(entity_details_model.model_validate_json(entity_details_result.content))
+
+      # Changed details (e.g. the KSeF submission announced by an account event) change the PDF as well
+      if not pdf_outdated and self.sync_state is not None and self.sync_state.has_changed(category, entity.id, content_hash(entity_details_content)):
+        await self.download_pdf(f'{base_endpoint_url}/{entity.id}/pdf.json', pdf_path)
+        pdf_count += 1
+      return entity_details_content
+
+    def rename_pdf(archived_name: str, target_name: str):
+      if os.path.exists(f'{dir_path}/pdf/{archived_name}.pdf'):
+        rename_file(f'{dir_path}/pdf/{archived_name}.pdf', f'{dir_path}/pdf/{target_name}.pdf')
+
+    listed_data = ListedDataDownloader(self.logger, self.infakt_client, category, dir_path, base_endpoint_url, response_model, entity_details_model, 'invoices data', details_concurrency=self.details_concurrency, incremental_sync=self.incremental_sync, sync_state=self.sync_state,
+      target_name=lambda entity: f'{entity.invoice_date} {entity.id}', period=lambda entity: str(entity.invoice_date), select=select_invoice, fetch_details=fetch_invoice_details, rename_extras=rename_pdf)
+    result: bool = await listed_data.process()
+
+    if result and pdf_count != listed_data.fetched_count:
+      self.logger.info('Downloaded %d out of %d PDFs - %s', pdf_count, listed_data.fetched_count, category)
+    return result
+
+  async def process(self) -> bool:
+    # The categories are independent, so they are fetched concurrently (sharing the client limits)
+    results: List[bool] = await asyncio.gather(
+      self.download_invoices_data('INVOICES', f'{self.infakt_domain}/api/v3/invoices', response_model=InfaktInvoiceResponse, entity_model=InfaktInvoiceEntity, entity_details_model=InfaktInvoiceEntityDetails),
+      self.download_invoices_data('CORRECTIVE_INVOICES', f'{self.infakt_domain}/api/v3/corrective_invoices', response_model=InfaktCorrectiveInvoiceResponse, entity_model=InfaktCorrectiveInvoiceEntity, entity_details_model=InfaktCorrectiveInvoiceEntityDetails)
+    )
+    return all(results)
@@ -0,0 +1,21 @@
+from typing import Any, Dict, Optional
+from pydantic import TypeAdapter
+
+# Serializes the archived data into the indented JSON bytes
+# The bytes come from pydantic only, as the git history of the data depends on their exact form
+class JsonSerializer():
+  def __init__(self):
+    self.adapters: Dict[Any, TypeAdapter] = {}
+
+  def adapter(self, model) -> TypeAdapter:
+    # Building an adapter compiles the schema, so every type gets it done only once
+    if model not in self.adapters:
+      self.adapters[model] = TypeAdapter(model)
+    return self.adapters[model]
+
+  def dump(self, value: Any, model: Optional[Any] = None, exclude: Optional[Any] = None, indent: Optional[int] = 2) -> bytes:
+    # No indent gives the compact single line form
+    adapter: TypeAdapter = self.adapter(model if model is not None else type(value))
+    return adapter.dump_json(value, indent=indent, exclude=exclude, exclude_none=True)
+
+json_serializer = JsonSerializer()
@@ -0,0 +1,143 @@
+import logging
+import os
+from typing import Any, Callable, Awaitable, Dict, Set, Optional
+
+from helpers import Paginator, SortedJsonListSpool, dump_to_file, ordered_map
+from InfaktClient import InfaktClient
+from JsonSerializer import json_serializer
+from IncrementalSync import IncrementalSync
+from SyncState import SyncState, SyncStateEntity, content_hash
+from DetailsManifest import DetailsManifest
+
+# Streams a listed category into {dir_path}/list.json and {dir_path}/details/{target name}.json
+# The categories differ only in the hooks:
+#   select(entity, entity_hash, archived, known_entity) - anything but None fetches the details (passed on to fetch_details)
+#   fetch_details(entity, selection) - returns the serialized details (extra downloads go along with them)
+#   rename_extras(archived_name, target_name) - moves the files kept next to the details (e.g. the invoice PDFs)
+class ListedDataDownloader():
+  def __init__(self, logger: logging.Logger, infakt_client: InfaktClient, category: str, dir_path: str, base_endpoint_url: str, response_model, entity_details_model, description: str, details_concurrency: int = 8, incremental_sync: Optional[IncrementalSync] = None, sync_state: Optional[SyncState] = None, details_from_list: bool = False, target_name: Callable[[Any], str] = lambda entity: f'{entity.id}', sort_key: Callable[[Any], Any] = lambda entity: entity.id, period: Callable[[Any], Optional[str]] = lambda entity: None, select: Optional[Callable[[Any, str, bool, Optional[SyncStateEntity]], Any]] = None, fetch_details: Optional[Callable[[Any, Any], Awaitable[bytes]]] = None, rename_extras: Optional[Callable[[str, str], None]] = None):
+    self.logger = logger
+    self.infakt_client = infakt_client
+    self.category = category
+    self.dir_path = dir_path
+    self.base_endpoint_url = base_endpoint_url
+    self.response_model = response_model
+    self.entity_details_model = entity_details_model
+    self.description = description # e.g. 'accounting data', used in the logs
+    self.details_concurrency = details_concurrency
+    self.incremental_sync = incremental_sync
+    self.sync_state = sync_state
+    self.details_from_list = details_from_list
+    self.target_name = target_name
+    self.sort_key = sort_key
+    self.period = period
+    self.select = select if select is not None else self.select_changed
+    self.fetch_details = fetch_details if fetch_details is not None else self.fetch_entity_details
+    self.rename_extras = rename_extras
+
+    # Statistics
+    self.listed_count: int = 0
+    self.fetched_count: int = 0
+    self.changed_count: int = 0
+
+  def select_changed(self, entity, entity_hash: str, archived: bool, known_entity: Optional[SyncStateEntity]) -> Optional[bool]:
+    # Skip the archived entities which were not changed since the last synchronization
+    if self.details_from_list or self.incremental_sync is None or self.incremental_sync.should_fetch_details(self.category, entity.id, archived):
+      return True
+    return None
+
+  async def fetch_entity_details(self, entity, selection) -> bytes:
+    if self.details_from_list:
+      return json_serializer.dump(self.entity_details_model.model_validate(entity, from_attributes=True))
+    entity_details_result = await self.infakt_client.get(f'{self.base_endpoint_url}/{entity.id}.json')
+    return json_serializer.dump(self.entity_details_model.model_validate_json(entity_details_result.content))
+
+  def rename(self, manifest: DetailsManifest, entity_id, archived_name: str, target_name: str):
+    manifest.rename(entity_id, f'{archived_name}.json', f'{target_name}.json')
+    if self.rename_extras is not None: self.rename_extras(archived_name, target_name)
+
+  async def process(self) -> bool:
+    try:
+      if not os.path.exists(self.dir_path): os.mkdir(self.dir_path)
+      if not os.path.exists(f'{self.dir_path}/details'): os.mkdir(f'{self.dir_path}/details')
+    except Exception as e:
+      self.logger.error('Failed to create directories required for %s handling - %s', self.description, self.category)
+      return False
+
+    try:
+      manifest = DetailsManifest(self.logger, self.sync_state, self.category, f'{self.dir_path}/details')
+      archived_entities_id: Dict[int, str] = manifest.load(rescan=self.incremental_sync is not None and self.incremental_sync.force_full_sync)
+      known_entities = self.sync_state.entities(self.category) if self.sync_state is not None else {}
+
+      listed_entities_id: Set[int] = set()
+      list_spool = SortedJsonListSpool()
+
+      async def listed_entities():
+        # Streams the entities from the pages as they arrive, writing the list once all of them are known
+        async for data_result in Paginator(self.infakt_client, f'{self.base_endpoint_url}.json', concurrency=self.details_concurrency):
+          parsed_data = self.response_model.model_validate_json(data_result.content)
+          if len(parsed_data.entities) == 0:
+            break
+
+          # The changes are known only after the account events are looked through
+          if self.incremental_sync is not None: await self.incremental_sync.wait_planned()
+          for entity in parsed_data.entities:
+            listed_entities_id.add(entity.id)
+            entity_content: bytes = json_serializer.dump(entity)
+            entity_hash: str = content_hash(entity_content)
+            list_spool.add(self.sort_key(entity), entity_content) # Sorted in ascending order once written
+
+            archived: bool = archived_entities_id.get(entity.id) == f'{self.target_name(entity)}.json'
+            selection = self.select(entity, entity_hash, archived, known_entities.get(str(entity.id)))
+            if selection is not None:
+              self.fetched_count += 1
+              yield entity, entity_hash, selection
+
+        # Save the entities list
+        list_spool.write_to(f'{self.dir_path}/list.json')
+
+      async def fetch_entity_details(listed_entity):
+        entity, entity_hash, selection = listed_entity
+
+        # Restore the paths if already exist
+        target_name: str = self.target_name(entity)
+        if entity.id in archived_entities_id and archived_entities_id[entity.id] != f'{target_name}.json':
+          self.rename(manifest, entity.id, archived_entities_id[entity.id][:-len('.json')], target_name)
+        return entity, entity_hash, await self.fetch_details(entity, selection)
+
+      # Fetch the details concurrently while the pages are still arriving
+      async for entity, entity_hash, entity_details_content in ordered_map(fetch_entity_details, listed_entities(), self.details_concurrency):
+        target_name: str = self.target_name(entity)
+
+        # Save entity to file
+        dump_to_file(f'{self.dir_path}/details/{target_name}.json', entity_details_content)
+
+        # Remember what was stored
+        if self.sync_state is not None:
+          entity_details_hash: str = content_hash(entity_details_content)
+          if self.sync_state.has_changed(self.category, entity.id, entity_details_hash): self.changed_count += 1
+          self.sync_state.update(self.category, entity.id, content_hash=entity_details_hash, file_name=f'{target_name}.json', period=self.period(entity), updated_marker=entity_hash)
+
+      self.listed_count = len(listed_entities_id)
+      if self.details_from_list:
+        self.logger.info('Built the details of %d entities from the list - %s', self.fetched_count, self.category)
+      elif self.fetched_count != self.listed_count:
+        self.logger.info('Fetched details of %d out of %d entities - %s', self.fetched_count, self.listed_count, self.category)
+
+      # Adjust deleted data names
+      deleted_entities_id = archived_entities_id.keys() - listed_entities_id
+      for deleted_entity_id in deleted_entities_id:
+        target_name: str = f'(DELETED) {deleted_entity_id}'
+        if archived_entities_id[deleted_entity_id] != f'{target_name}.json':
+          self.rename(manifest, deleted_entity_id, archived_entities_id[deleted_entity_id][:-len('.json')], target_name)
+
+      if self.sync_state is not None:
+        manifest.save()
+        self.sync_state.commit()
+        self.logger.info('%d entities changed since the last fetch - %s', self.changed_count, self.category)
+
+      self.logger.info('Finished fetching %s - %s', self.description, self.category)
+      return True
+    except Exception as e:
+      self.logger.error('Failed to handle %s - %s %s %s', self.description, self.category, type(e), e)
+      return False
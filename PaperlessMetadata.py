@@ -0,0 +1,84 @@
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Any
+from pypaperless import Paperless
+
+from SyncState import SyncState
+
+METADATA_KINDS = ['tags', 'custom_fields', 'document_types']
+
+# Resolves the Paperless tags, custom fields and document types by their names
+# The name -> id mapping is kept in the sync state, the objects are fetched once per run
+class PaperlessMetadata():
+  def __init__(self, logger: logging.Logger, paperless: Paperless, sync_state: SyncState, ttl: timedelta = timedelta(hours=24)):
+    self.logger = logger
+    self.paperless = paperless
+    self.sync_state = sync_state
+    self.ttl = ttl
+    self.ids: Optional[Dict[str, Dict[str, int]]] = None # kind -> name -> id
+    self.objects: Dict[tuple, Any] = {}
+    self.lock = asyncio.Lock()
+
+  def load(self) -> bool:
+    raw_cache: Optional[str] = self.sync_state.get_metadata('paperless_metadata')
+    if raw_cache is None:
+      return False
+    cache = json.loads(raw_cache)
+    if datetime.now() - datetime.fromisoformat(cache['fetched_at']) > self.ttl:
+      return False
+    self.ids = cache['ids']
+    return True
+
+  async def refresh(self):
+    # List all the metadata at once - it is small and every lookup by name needs it anyway
+    self.logger.info('Fetching the Paperless metadata')
+    ids: Dict[str, Dict[str, int]] = {}
+    for kind in METADATA_KINDS:
+      ids[kind] = {}
+      async for item in getattr(self.paperless, kind):
+        ids[kind][item.name] = item.id
+    self.ids = ids
+    self.objects = {}
+    self.sync_state.set_metadata('paperless_metadata', json.dumps({ 'fetched_at': datetime.now().isoformat(), 'ids': ids }))
+    self.sync_state.commit()
+
+  async def resolve(self, kind: str, name: str):
+    async with self.lock:
+      if (kind, name) in self.objects:
+        return self.objects[(kind, name)]
+
+      refreshed: bool = False
+      if self.ids is None and not self.load():
+        await self.refresh()
+        refreshed = True
+
+      while True:
+        item_id: Optional[int] = self.ids[kind].get(name)
+        if item_id is not None:
+          try:
+            item = await getattr(self.paperless, kind)(item_id)
+            if item.name == name:
+              self.objects[(kind, name)] = item
+              return item
+          except Exception as e:
+            self.logger.warning('Failed to fetch the Paperless %s %d (%s) - %s %s', kind, item_id, name, type(e), e)
+
+        # The cached mapping may be outdated (renamed or removed items)
+        if refreshed:
+          raise Exception(f'Paperless {kind} "{name}" not found')
+        await self.refresh()
+        refreshed = True
+
+  async def tag(self, name: str):
+    return await self.resolve('tags', name)
+
+  async def tags(self, names: List[str]) -> List:
+    return [await self.tag(name) for name in names]
+
+  async def custom_field(self, name: str):
+    return await self.resolve('custom_fields', name)
+
+  async def document_type(self, name: str):
+    return await self.resolve('document_types', name)
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Optional
+from pypaperless import Paperless
+from pypaperless.models.common import TaskStatusType
+
+# Tracks many pending Paperless consume tasks at once and resolves the waiters as they finish
+class PaperlessTaskPoller():
+  def __init__(self, logger: logging.Logger, paperless: Paperless, initial_interval: float = 0.5, max_interval: float = 10, timeout: float = 600, max_failures: int = 5):
+    self.logger = logger
+    self.paperless = paperless
+    self.initial_interval = initial_interval
+    self.max_interval = max_interval
+    self.timeout = timeout # Per task, counted from the first wait
+    self.max_failures = max_failures # Consecutive failed checks of a task (e.g. pruned, acknowledged or unknown tasks)
+    self.pending: Dict[str, asyncio.Future] = {}
+    self.deadlines: Dict[str, float] = {}
+    self.failures: Dict[str, int] = {}
+    self.poll_task: Optional[asyncio.Task] = None
+
+  async def wait(self, task_id: str):
+    if task_id not in self.pending:
+      self.pending[task_id] = asyncio.get_running_loop().create_future()
+      self.deadlines[task_id] = time.monotonic() + self.timeout
+      self.failures[task_id] = 0
+    future: asyncio.Future = self.pending[task_id]
+
+    # Start polling if not running yet
+    if self.poll_task is None or self.poll_task.done():
+      self.poll_task = asyncio.create_task(self.poll())
+    return await future
+
+  def resolve(self, task_id: str, task=None, exception: Optional[Exception] = None):
+    future: asyncio.Future = self.pending.pop(task_id)
+    del self.deadlines[task_id]
+    del self.failures[task_id]
+    if future.done():
+      return
+    if exception is not None:
+      future.set_exception(exception)
+    else:
+      future.set_result(task)
+
+  async def list_tasks(self) -> Dict[str, Any]:
+    # A single request lists all the tasks, so a round costs the same whatever the number of the pending ones
+    return { task.task_id: task async for task in self.paperless.tasks }
+
+  def check(self, task_id: str, task, error: Optional[str] = None) -> bool:
+    if task is None:
+      self.failures[task_id] += 1
+      if self.failures[task_id] >= self.max_failures:
+        self.resolve(task_id, exception=Exception(f'Failed to check the Paperless task {task_id} - {error}'))
+        return True
+      return False
+    self.failures[task_id] = 0
+
+    if task.status in [TaskStatusType.PENDING, TaskStatusType.STARTED]:
+      if time.monotonic() >= self.deadlines[task_id]:
+        self.resolve(task_id, exception=Exception(f'Paperless task {task_id} did not finish in {self.timeout}s'))
+        return True
+      return False
+
+    self.resolve(task_id, task=task)
+    return True
+
+  async def poll(self):
+    interval: float = self.initial_interval
+    while len(self.pending) > 0:
+      await asyncio.sleep(interval)
+
+      # Check all the pending tasks against one listing
+      tasks: Dict[str, Any] = {}
+      error: str = 'not listed by Paperless'
+      try:
+        tasks = await self.list_tasks()
+      except Exception as e:
+        error = f'{type(e)} {e}'
+        self.logger.warning('Failed to list the Paperless tasks (%d pending) - %s', len(self.pending), error)
+      finished_count: int = sum(self.check(task_id, tasks.get(task_id), error) for task_id in list(self.pending.keys()))
+
+      # Back off exponentially while nothing finishes
+      interval = self.initial_interval if finished_count > 0 else min(interval * 2, self.max_interval)
@@ -0,0 +1,61 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+# Process-wide token bucket - paces the requests ahead of time instead of reacting to 429s
+class RateLimiter():
+  def __init__(self, requests_per_second: float, burst: int = 1):
+    self.requests_per_second = requests_per_second
+    self.capacity = max(burst, 1)
+    self.tokens: float = self.capacity
+    self.updated_at: float = time.monotonic()
+    self.blocked_until: float = 0
+    self.lock = asyncio.Lock()
+
+    # Statistics
+    self.acquired_count: int = 0
+    self.total_wait_time: float = 0
+
+  def refill(self, now: float):
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.requests_per_second)
+    self.updated_at = now
+
+  async def acquire(self):
+    started_at: float = time.monotonic()
+    async with self.lock: # The waiters are served in order
+      while True:
+        now: float = time.monotonic()
+        if now < self.blocked_until: # Blocked by the Retry-After header
+          await asyncio.sleep(self.blocked_until - now)
+          continue
+
+        self.refill(now)
+        if self.tokens >= 1:
+          self.tokens -= 1
+          break
+        await asyncio.sleep((1 - self.tokens) / self.requests_per_second)
+
+    self.acquired_count += 1
+    self.total_wait_time += time.monotonic() - started_at
+
+  def block_for(self, seconds: float):
+    # Hold back every caller (including the ones already waiting) and drain the bucket
+    now: float = time.monotonic()
+    self.blocked_until = max(self.blocked_until, now + seconds)
+    self.refill(now)
+    self.tokens = 0
+
+def parse_retry_after(value: Optional[str], default: float = 1) -> float:
+  # Retry-After can be given either in seconds or as a HTTP date
+  if value is None:
+    return default
+  try:
+    return max(float(value), 0)
+  except ValueError:
+    pass
+  try:
+    return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+  except (TypeError, ValueError):
+    return default
@@ -0,0 +1,156 @@
+import hashlib
+import os
+import sqlite3
+from datetime import datetime
+from typing import Optional, Dict
+from pydantic import BaseModel
+
+class SyncStateEntity(BaseModel):
+  category: str
+  entity_id: str
+  content_hash: Optional[str] = None
+  file_name: Optional[str] = None
+  period: Optional[str] = None
+  updated_marker: Optional[str] = None
+  fetched_at: Optional[datetime] = None
+
+class SyncStateAttachment(BaseModel):
+  document_scan_uuid: str
+  content_hash: str
+  file_name: str
+  size: int
+  fetched_at: Optional[datetime] = None
+
+def content_hash(content: str | bytes) -> str:
+  if isinstance(content, str):
+    content = content.encode()
+  return hashlib.sha256(content).hexdigest()
+
+# Embedded store of the synchronization state kept between the runs
+class SyncState():
+  def __init__(self, path: str = 'state/sync_state.sqlite'):
+    self.path = path
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    self.connection = sqlite3.connect(path)
+    self.connection.execute('''
+      CREATE TABLE IF NOT EXISTS entities (
+        category TEXT NOT NULL,
+        entity_id TEXT NOT NULL,
+        content_hash TEXT,
+        file_name TEXT,
+        period TEXT,
+        updated_marker TEXT,
+        fetched_at TEXT,
+        PRIMARY KEY (category, entity_id)
+      )
+    ''')
+    self.connection.execute('''
+      CREATE TABLE IF NOT EXISTS attachments (
+        document_scan_uuid TEXT PRIMARY KEY,
+        content_hash TEXT NOT NULL,
+        file_name TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        fetched_at TEXT
+      )
+    ''')
+    self.connection.execute('''
+      CREATE TABLE IF NOT EXISTS metadata (
+        key TEXT PRIMARY KEY,
+        value TEXT
+      )
+    ''')
+    self.connection.commit()
+
+  def close(self):
+    self.connection.commit()
+    self.connection.close()
+
+  def commit(self):
+    self.connection.commit()
+
+  def get(self, category: str, entity_id: int | str) -> Optional[SyncStateEntity]:
+    row = self.connection.execute(
+      'SELECT category, entity_id, content_hash, file_name, period, updated_marker, fetched_at FROM entities WHERE category = ? AND entity_id = ?',
+      (category, str(entity_id))
+    ).fetchone()
+    return self.row_to_entity(row) if row is not None else None
+
+  def entities(self, category: str) -> Dict[str, SyncStateEntity]:
+    rows = self.connection.execute(
+      'SELECT category, entity_id, content_hash, file_name, period, updated_marker, fetched_at FROM entities WHERE category = ?',
+      (category,)
+    ).fetchall()
+    return { row[1]: self.row_to_entity(row) for row in rows }
+
+  def file_names(self, category: str) -> Dict[str, str]:
+    rows = self.connection.execute(
+      'SELECT entity_id, file_name FROM entities WHERE category = ? AND file_name IS NOT NULL',
+      (category,)
+    ).fetchall()
+    return { row[0]: row[1] for row in rows }
+
+  def has_changed(self, category: str, entity_id: int | str, new_content_hash: str) -> bool:
+    row = self.connection.execute(
+      'SELECT content_hash FROM entities WHERE category = ? AND entity_id = ?',
+      (category, str(entity_id))
+    ).fetchone()
+    return row is None or row[0] != new_content_hash
+
+  def update(self, category: str, entity_id: int | str, content_hash: Optional[str] = None, file_name: Optional[str] = None, period: Optional[str] = None, updated_marker: Optional[str] = None, fetched: bool = True):
+    # Missing values keep the previously stored ones
+    self.connection.execute('''
+      INSERT INTO entities (category, entity_id, content_hash, file_name, period, updated_marker, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?)
+      ON CONFLICT (category, entity_id) DO UPDATE SET
+        content_hash = COALESCE(excluded.content_hash, content_hash),
+        file_name = COALESCE(excluded.file_name, file_name),
+        period = COALESCE(excluded.period, period),
+        updated_marker = COALESCE(excluded.updated_marker, updated_marker),
+        fetched_at = COALESCE(excluded.fetched_at, fetched_at)
+    ''', (category, str(entity_id), content_hash, file_name, period, updated_marker, datetime.now().isoformat() if fetched else None))
+
+  def clear_file_name(self, category: str, entity_id: int | str):
+    self.connection.execute('UPDATE entities SET file_name = NULL WHERE category = ? AND entity_id = ?', (category, str(entity_id)))
+
+  def get_attachment(self, document_scan_uuid: str) -> Optional[SyncStateAttachment]:
+    row = self.connection.execute(
+      'SELECT document_scan_uuid, content_hash, file_name, size, fetched_at FROM attachments WHERE document_scan_uuid = ?',
+      (document_scan_uuid,)
+    ).fetchone()
+    if row is None:
+      return None
+    return SyncStateAttachment(
+      document_scan_uuid=row[0],
+      content_hash=row[1],
+      file_name=row[2],
+      size=row[3],
+      fetched_at=datetime.fromisoformat(row[4]) if row[4] is not None else None
+    )
+
+  def update_attachment(self, document_scan_uuid: str, content_hash: str, file_name: str, size: int):
+    self.connection.execute('''
+      INSERT INTO attachments (document_scan_uuid, content_hash, file_name, size, fetched_at) VALUES (?, ?, ?, ?, ?)
+      ON CONFLICT (document_scan_uuid) DO UPDATE SET
+        content_hash = excluded.content_hash,
+        file_name = excluded.file_name,
+        size = excluded.size,
+        fetched_at = excluded.fetched_at
+    ''', (document_scan_uuid, content_hash, file_name, size, datetime.now().isoformat()))
+
+  def get_metadata(self, key: str) -> Optional[str]:
+    row = self.connection.execute('SELECT value FROM metadata WHERE key = ?', (key,)).fetchone()
+    return row[0] if row is not None else None
+
+  def set_metadata(self, key: str, value: Optional[str]):
+    self.connection.execute('INSERT INTO metadata (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value', (key, value))
+
+  @staticmethod
+  def row_to_entity(row) -> SyncStateEntity:
+    return SyncStateEntity(
+      category=row[0],
+      entity_id=row[1],
+      content_hash=row[2],
+      file_name=row[3],
+      period=row[4],
+      updated_marker=row[5],
+      fetched_at=datetime.fromisoformat(row[6]) if row[6] is not None else None
+    )
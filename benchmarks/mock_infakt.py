@@ -0,0 +1,372 @@
+# Local stand-in for the InFakt API (/api/v3/...) serving synthetic data in the shapes of the models/ classes
+# Usage: python benchmarks/mock_infakt.py [--port 8765] [--scale 10000] [--latency-ms 20] [--rate-limit-ratio 0.01]
+#
+# The entities are generated on demand from their index, so even 100k entities per collection take no memory.
+# Control endpoints (not counted, delayed nor rate limited):
+#   GET  /_mock/stats   - requests, bytes and 429s served since the last reset
+#   POST /_mock/reset   - resets the statistics
+#   POST /_mock/advance - changes a batch of entities in every collection and records the account events for them
+import argparse
+import asyncio
+import enum
+import os
+import random
+import re
+import sys
+import time
+import types
+import typing
+import uuid
+from collections import deque
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from aiohttp import web
+from pydantic import BaseModel
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from models.InfaktDatetime import INFAKT_DATETIME_FORMAT, INFAKT_EVENT_DATETIME_FORMAT
+from models.InfaktAccountDetails import InfaktAccountDetails
+from models.InfaktAccountDetails import InfaktClientEntity, InfaktClientEntityDetails
+from models.InfaktAccountDetails import InfaktProductEntity, InfaktProductEntityDetails
+from models.InfaktAccountDetails import InfaktBankAccountEntity, InfaktBankAccountEntityDetails
+from models.InfaktAccountEvents import InfaktAccountEvent, InfaktAccountEventActionSymbol
+from models.InfaktAccounting import InfaktSAFV7Entity, InfaktSAFV7EntityDetails
+from models.InfaktAccounting import InfaktVATEUEntity, InfaktVATEUEntityDetails
+from models.InfaktAccounting import InfaktBookEntity, InfaktBookEntityDetails
+from models.InfaktAccounting import InfaktIncomeTaxEntity, InfaktIncomeTaxEntityDetails
+from models.InfaktAccounting import InfaktInsuranceEntity, InfaktInsuranceEntityDetails
+from models.InfaktInvoices import InfaktInvoiceEntity, InfaktInvoiceEntityDetails
+from models.InfaktInvoices import InfaktCorrectiveInvoiceEntity, InfaktCorrectiveInvoiceEntityDetails
+from models.InfaktCosts import InfaktCostEntity, InfaktCostEntityDetailed
+
+# Fields parsed by the custom validators (everything else takes ISO timestamps)
+EVENT_DATETIME_FIELDS = { 'performed_at' }
+
+GENERATED_FROM = datetime(2020, 1, 1, 8, 0, 0)
+
+class MockCollection():
+  def __init__(self, name: str, path: str, subject_type: str, entity_model, details_model, count: int, key: str = 'id', monthly: bool = False):
+    self.name = name
+    self.path = path
+    self.subject_type = subject_type # Named as in the account events
+    self.entity_model = entity_model
+    self.details_model = details_model
+    self.count = count
+    self.key = key # Field the details are looked up by
+    self.monthly = monthly # One entity per accounting period
+    self.number = 0 # Set by the server, makes the UUIDs of the collections distinct
+
+  def entity_uuid(self, index: int) -> str:
+    return str(uuid.UUID(int=(self.number << 64) | index))
+
+  def index_of(self, key: str) -> Optional[int]:
+    try:
+      index: int = uuid.UUID(key).int & ((1 << 64) - 1) if self.key == 'uuid' else int(key)
+    except ValueError:
+      return None
+    return index if 1 <= index <= self.count else None
+
+class MockConfig():
+  def __init__(self, scale: int = 10000, periods: int = 72, latency: float = 0, latency_jitter: float = 0, rate_limit_ratio: float = 0, max_requests_per_second: float = 0, retry_after: float = 0.1, pdf_size: int = 64 * 1024, attachment_size: int = 128 * 1024, distinct_attachments: Optional[int] = None, changes_per_advance: int = 25, seed: int = 0):
+    self.scale = scale
+    self.periods = periods
+    self.latency = latency
+    self.latency_jitter = latency_jitter
+    self.rate_limit_ratio = rate_limit_ratio
+    self.max_requests_per_second = max_requests_per_second
+    self.retry_after = retry_after
+    self.pdf_size = pdf_size
+    self.attachment_size = attachment_size
+    self.distinct_attachments = distinct_attachments if distinct_attachments is not None else max(scale // 2, 1)
+    self.changes_per_advance = changes_per_advance
+    self.seed = seed
+
+@lru_cache(maxsize=None)
+def model_fields(model) -> List[Tuple[str, Any]]:
+  return [(name, field.annotation) for name, field in model.model_fields.items()]
+
+@lru_cache(maxsize=None)
+def validated_fields(model) -> frozenset:
+  fields = set()
+  for decorator in model.__pydantic_decorators__.field_validators.values():
+    fields.update(decorator.info.fields)
+  return frozenset(fields)
+
+def fake_value(annotation, index: int, variant: int = 0, field_name: str = '', validated: bool = False) -> Any:
+  # Builds a value accepted by the annotation, deterministic for the index (the variant changes the texts only)
+  origin = typing.get_origin(annotation)
+  arguments = typing.get_args(annotation)
+  if annotation is type(None):
+    return None
+  if origin in (typing.Union, types.UnionType):
+    non_none_arguments = [argument for argument in arguments if argument is not type(None)]
+    return fake_value(non_none_arguments[0], index, variant, field_name, validated) if len(non_none_arguments) > 0 else None
+  if origin in (list, List):
+    return [fake_value(arguments[0], index, variant, field_name)] if len(arguments) > 0 and arguments[0] is not type(None) else []
+  if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+    return fake_entity(annotation, index, variant)
+  if isinstance(annotation, type) and issubclass(annotation, enum.Enum):
+    members = list(annotation)
+    return members[index % len(members)].value
+  if annotation is bool:
+    return index % 2 == 0
+  if annotation is int:
+    return index * 100 + variant
+  if annotation is float:
+    return float(index) + variant / 100
+  if annotation is datetime:
+    moment: datetime = GENERATED_FROM + timedelta(hours=index)
+    if not validated:
+      return moment.isoformat() + '+01:00'
+    return moment.strftime(INFAKT_EVENT_DATETIME_FORMAT if field_name in EVENT_DATETIME_FIELDS else INFAKT_DATETIME_FORMAT.replace('%z', '+0100'))
+  if annotation is date:
+    return (GENERATED_FROM.date() + timedelta(days=index % 2000)).isoformat()
+  type_name: str = getattr(annotation, '__name__', '')
+  if type_name == 'Currency':
+    return 'PLN'
+  if type_name == 'CountryAlpha2':
+    return 'PL'
+  return f'{field_name} {index}' + (f' v{variant}' if variant > 0 else '')
+
+def fake_entity(model, index: int, variant: int = 0) -> Dict[str, Any]:
+  validated = validated_fields(model)
+  return { name: fake_value(annotation, index, variant, name, name in validated) for name, annotation in model_fields(model) }
+
+class MockInfaktServer():
+  def __init__(self, config: MockConfig):
+    self.config = config
+    self.random = random.Random(config.seed)
+    scale: int = config.scale
+    self.collections: Dict[str, MockCollection] = { collection.path: collection for collection in [
+      MockCollection('CLIENTS', 'clients', 'Client', InfaktClientEntity, InfaktClientEntityDetails, max(scale // 10, 1)),
+      MockCollection('PRODUCTS', 'products', 'Product', InfaktProductEntity, InfaktProductEntityDetails, max(scale // 20, 1)),
+      MockCollection('BANK_ACCOUNTS', 'bank_accounts', 'BankAccount', InfaktBankAccountEntity, InfaktBankAccountEntityDetails, 3),
+      MockCollection('JPK', 'saf_v7_files', 'SafV7File', InfaktSAFV7Entity, InfaktSAFV7EntityDetails, config.periods, monthly=True),
+      MockCollection('VAT_EU', 'vat_eu_taxes', 'VatEuTax', InfaktVATEUEntity, InfaktVATEUEntityDetails, config.periods, monthly=True),
+      MockCollection('REV_TAX', 'income_taxes', 'IncomeTax', InfaktIncomeTaxEntity, InfaktIncomeTaxEntityDetails, config.periods, monthly=True),
+      MockCollection('KPiR', 'books', 'Book', InfaktBookEntity, InfaktBookEntityDetails, config.periods, monthly=True),
+      MockCollection('INSUR', 'insurance_fees', 'InsuranceFee', InfaktInsuranceEntity, InfaktInsuranceEntityDetails, config.periods, monthly=True),
+      MockCollection('INVOICES', 'invoices', 'Invoice', InfaktInvoiceEntity, InfaktInvoiceEntityDetails, scale),
+      MockCollection('CORRECTIVE_INVOICES', 'corrective_invoices', 'CorrectiveInvoice', InfaktCorrectiveInvoiceEntity, InfaktCorrectiveInvoiceEntityDetails, max(scale // 10, 1)),
+      MockCollection('COSTS', 'documents/costs', 'Cost', InfaktCostEntity, InfaktCostEntityDetailed, scale, key='uuid')
+    ] }
+    for number, collection in enumerate(self.collections.values(), start=1):
+      collection.number = number
+    self.events_count: int = scale
+
+    # Changes made by /_mock/advance - the variant of the changed entities and the events recorded for them
+    self.revision: int = 0
+    self.variants: Dict[str, Dict[int, int]] = { collection.path: {} for collection in self.collections.values() }
+    self.changed_events: List[Tuple[MockCollection, int]] = []
+
+    self.base_url: str = ''
+    self.reset_stats()
+
+  def reset_stats(self):
+    self.stats: Dict[str, Any] = { 'requests': 0, 'bytes': 0, 'rate_limited': 0, 'endpoints': {} }
+    self.recent_requests: Deque[float] = deque()
+
+  # Data
+
+  def entity(self, collection: MockCollection, index: int, detailed: bool = False) -> Dict[str, Any]:
+    entity: Dict[str, Any] = fake_entity(collection.details_model if detailed else collection.entity_model, index, self.variants[collection.path].get(index, 0))
+    if 'id' in entity: entity['id'] = index
+    if 'uuid' in entity: entity['uuid'] = collection.entity_uuid(index)
+    if collection.monthly:
+      period: date = date(GENERATED_FROM.year + (index - 1) // 12, (index - 1) % 12 + 1, 1)
+      for field_name in ('period', 'date'):
+        if field_name in entity: entity[field_name] = period.isoformat()
+    if detailed and 'attachments' in entity:
+      # Scanned documents repeat, so some of the attachments share their content
+      for attachment in entity['attachments']:
+        attachment['document_scan_uuid'] = str(uuid.UUID(int=index))
+        attachment['file_name'] = f'scan {index}.pdf'
+        attachment['download_url'] = f'{self.base_url}/_files/{index % self.config.distinct_attachments}.pdf?token={self.random.getrandbits(32)}'
+    return entity
+
+  def event(self, number: int) -> Dict[str, Any]:
+    # Numbered from the oldest one, the changes made by /_mock/advance follow the generated history
+    event: Dict[str, Any] = fake_entity(InfaktAccountEvent, number)
+    event['id'] = number
+    event['performed_at'] = (GENERATED_FROM + timedelta(minutes=17 * number)).strftime(INFAKT_EVENT_DATETIME_FORMAT)
+    if number <= self.events_count:
+      subject_types: List[str] = ['Client', 'Product', 'Invoice', 'Cost', 'Book']
+      if number % 3 == 0:
+        event['action_symbol'] = InfaktAccountEventActionSymbol.LOGIN.value
+        event['subject_type'] = 'User'
+      else:
+        event['action_symbol'] = InfaktAccountEventActionSymbol.UPDATE.value
+        event['subject_type'] = subject_types[number % len(subject_types)]
+      event['subject_id'] = number % max(self.config.scale // 10, 1) + 1
+    else:
+      collection, index = self.changed_events[number - self.events_count - 1]
+      event['action_symbol'] = InfaktAccountEventActionSymbol.UPDATE.value
+      event['subject_type'] = collection.subject_type
+      event['subject_id'] = index
+    return event
+
+  def advance(self) -> int:
+    self.revision += 1
+    changed_count: int = 0
+    for collection in self.collections.values():
+      for _ in range(min(self.config.changes_per_advance, collection.count)):
+        index: int = self.random.randint(1, collection.count)
+        self.variants[collection.path][index] = self.revision
+        self.changed_events.append((collection, index))
+        changed_count += 1
+    return changed_count
+
+  # Handlers
+
+  @property
+  def total_events(self) -> int:
+    return self.events_count + len(self.changed_events)
+
+  @staticmethod
+  def page_params(request: web.Request) -> Tuple[int, int]:
+    return int(request.query.get('limit', 10)), int(request.query.get('offset', 0))
+
+  async def account_details(self, request: web.Request) -> web.Response:
+    return web.json_response(fake_entity(InfaktAccountDetails, 1))
+
+  async def account_events(self, request: web.Request) -> web.Response:
+    # Listed from the newest ones
+    limit, offset = self.page_params(request)
+    total_count: int = self.total_events
+    entities = [self.event(total_count - position) for position in range(offset, min(offset + limit, total_count))]
+    return web.json_response({ 'total_count': total_count, 'count': len(entities), 'entities': entities })
+
+  async def list_entities(self, request: web.Request) -> web.Response:
+    collection: Optional[MockCollection] = self.collections.get(request.match_info['collection'])
+    if collection is None:
+      raise web.HTTPNotFound()
+    limit, offset = self.page_params(request)
+    entities = [self.entity(collection, index) for index in range(offset + 1, min(offset + limit, collection.count) + 1)]
+    return web.json_response({ 'metainfo': { 'count': len(entities), 'total_count': collection.count, 'next': '', 'previous': '' }, 'entities': entities })
+
+  async def entity_details(self, request: web.Request) -> web.Response:
+    collection: Optional[MockCollection] = self.collections.get(request.match_info['collection'])
+    index: Optional[int] = collection.index_of(request.match_info['key']) if collection is not None else None
+    if index is None:
+      raise web.HTTPNotFound()
+    return web.json_response(self.entity(collection, index, detailed=True))
+
+  async def stream_file(self, request: web.Request, seed: str, size: int) -> web.StreamResponse:
+    response = web.StreamResponse(headers={ 'Content-Type': 'application/pdf' })
+    await response.prepare(request)
+    chunk: bytes = (b'%PDF-1.4 ' + seed.encode() + b' ') * 64
+    remaining: int = size
+    while remaining > 0:
+      await response.write(chunk[:remaining])
+      remaining -= len(chunk[:remaining])
+    await response.write_eof()
+    return response
+
+  async def invoice_pdf(self, request: web.Request) -> web.StreamResponse:
+    collection: Optional[MockCollection] = self.collections.get(request.match_info['collection'])
+    if collection is None or collection.index_of(request.match_info['key']) is None:
+      raise web.HTTPNotFound()
+    if request.headers.get('X-inFakt-ApiKey') is None:
+      raise web.HTTPUnauthorized()
+    return await self.stream_file(request, f'{collection.path} {request.match_info["key"]}', self.config.pdf_size)
+
+  async def attachment(self, request: web.Request) -> web.StreamResponse:
+    return await self.stream_file(request, f'scan {request.match_info["number"]}', self.config.attachment_size)
+
+  async def get_stats(self, request: web.Request) -> web.Response:
+    return web.json_response(self.stats)
+
+  async def post_reset(self, request: web.Request) -> web.Response:
+    self.reset_stats()
+    return web.json_response({ 'reset': True })
+
+  async def post_advance(self, request: web.Request) -> web.Response:
+    return web.json_response({ 'revision': self.revision, 'changed': self.advance() })
+
+  @web.middleware
+  async def middleware(self, request: web.Request, handler):
+    self.base_url = f'{request.scheme}://{request.host}'
+    if request.path.startswith('/_mock/'):
+      return await handler(request)
+
+    endpoint: str = request.match_info.route.name
+    if 'collection' in request.match_info: endpoint = f'{request.match_info["collection"]} {endpoint}'
+    self.stats['requests'] += 1
+    self.stats['endpoints'][endpoint] = self.stats['endpoints'].get(endpoint, 0) + 1
+
+    # Rate limiting - either at random or once the requests per second go over the limit
+    now: float = time.monotonic()
+    self.recent_requests.append(now)
+    while self.recent_requests[0] < now - 1:
+      self.recent_requests.popleft()
+    over_limit: bool = self.config.max_requests_per_second > 0 and len(self.recent_requests) > self.config.max_requests_per_second
+    if over_limit or (self.config.rate_limit_ratio > 0 and self.random.random() < self.config.rate_limit_ratio):
+      self.stats['rate_limited'] += 1
+      return web.Response(status=429, headers={ 'Retry-After': str(self.config.retry_after) })
+
+    if self.config.latency > 0 or self.config.latency_jitter > 0:
+      await asyncio.sleep(self.config.latency + self.random.random() * self.config.latency_jitter)
+
+    response = await handler(request)
+    if isinstance(response, web.Response) and response.body is not None:
+      self.stats['bytes'] += len(response.body)
+    else:
+      self.stats['bytes'] += response.body_length
+    return response
+
+  def app(self) -> web.Application:
+    app = web.Application(middlewares=[self.middleware])
+    app.router.add_get('/_mock/stats', self.get_stats)
+    app.router.add_post('/_mock/reset', self.post_reset)
+    app.router.add_post('/_mock/advance', self.post_advance)
+    app.router.add_get('/_files/{number}.pdf', self.attachment, name='attachment')
+    app.router.add_get('/api/v3/account/details.json', self.account_details, name='account-details')
+    app.router.add_get('/api/v3/account/activities.json', self.account_events, name='account-events')
+
+    # The collection paths are listed explicitly, as the costs are nested in the documents
+    collection_pattern: str = '|'.join(re.escape(path) for path in self.collections.keys())
+    app.router.add_get(f'/api/v3/{{collection:{collection_pattern}}}.json', self.list_entities, name='list')
+    app.router.add_get(f'/api/v3/{{collection:{collection_pattern}}}/{{key}}/pdf.json', self.invoice_pdf, name='pdf')
+    app.router.add_get(f'/api/v3/{{collection:{collection_pattern}}}/{{key}}.json', self.entity_details, name='details')
+    return app
+
+def serve(host: str, port: int, config: MockConfig):
+  web.run_app(MockInfaktServer(config).app(), host=host, port=port, print=None, access_log=None)
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+  parser.add_argument('--scale', type=int, default=10000, help='costs, invoices and events count (the other collections are derived from it)')
+  parser.add_argument('--periods', type=int, default=72, help='accounting periods (months)')
+  parser.add_argument('--latency-ms', type=float, default=0, help='delay added to every API request')
+  parser.add_argument('--jitter-ms', type=float, default=0, help='random delay added on top of the latency')
+  parser.add_argument('--rate-limit-ratio', type=float, default=0, help='share of the API requests answered with 429')
+  parser.add_argument('--max-rps', type=float, default=0, help='requests per second over which 429 is returned (0 disables)')
+  parser.add_argument('--retry-after', type=float, default=0.1, help='Retry-After of the 429 responses in seconds')
+  parser.add_argument('--pdf-kb', type=int, default=64, help='size of the invoice PDFs')
+  parser.add_argument('--attachment-kb', type=int, default=128, help='size of the cost attachments')
+  parser.add_argument('--changes', type=int, default=25, help='entities changed in every collection by /_mock/advance')
+  parser.add_argument('--seed', type=int, default=0)
+
+def config_from_arguments(arguments: argparse.Namespace) -> MockConfig:
+  return MockConfig(
+    scale=arguments.scale,
+    periods=arguments.periods,
+    latency=arguments.latency_ms / 1000,
+    latency_jitter=arguments.jitter_ms / 1000,
+    rate_limit_ratio=arguments.rate_limit_ratio,
+    max_requests_per_second=arguments.max_rps,
+    retry_after=arguments.retry_after,
+    pdf_size=arguments.pdf_kb * 1024,
+    attachment_size=arguments.attachment_kb * 1024,
+    changes_per_advance=arguments.changes,
+    seed=arguments.seed
+  )
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Mock InFakt API server')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8765)
+  add_config_arguments(parser)
+  arguments = parser.parse_args()
+  print(f'Serving the mock InFakt API at http://{arguments.host}:{arguments.port}')
+  serve(arguments.host, arguments.port, config_from_arguments(arguments))
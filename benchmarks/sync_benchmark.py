@@ -0,0 +1,227 @@
+# End-to-end benchmark of the downloaders against the mock InFakt API (benchmarks/mock_infakt.py)
+# Usage: python benchmarks/sync_benchmark.py [--scale 10000] [--latency-ms 20] [--rate-limit-ratio 0.01] [--stages all]
+#        [--output results.json] [--baseline results.json]
+#
+# Every stage runs three times in the same working directory: from scratch (cold), again without any changes (warm)
+# and once more after a batch of entities was changed on the server (changed). Each run is a fresh process,
+# so the peak RSS belongs to that run only. The account events are always planned along with the stage, as in main.py.
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from mock_infakt import serve, add_config_arguments, config_from_arguments
+
+STAGES = ['account', 'accounting', 'invoices', 'costs', 'all']
+RUNS = ['cold', 'warm', 'changed']
+
+# Metrics compared with the baseline (relative growth above the tolerance is reported)
+COMPARED_METRICS = ['wall_time', 'requests', 'bytes', 'peak_rss_mb', 'files_written']
+
+async def run_stage(stage: str, infakt_domain: str, options: Dict[str, Any]) -> Dict[str, Any]:
+  # Imported here, so the parent process stays small and the measured memory belongs to the run
+  from InfaktClient import InfaktClient
+  from RateLimiter import RateLimiter
+  from SyncState import SyncState
+  from IncrementalSync import IncrementalSync
+  from AttachmentStore import AttachmentStore
+  from AccountDetailsDownloader import AccountDetailsDownloader
+  from AccountingDownloader import AccountingDownloader
+  from InvoicesDownloader import InvoicesDownloader
+  from CostsDownloader import CostsDownloader
+  from helpers import write_journal
+
+  logger = logging.getLogger('benchmark')
+  rate_limiter = RateLimiter(options['requests_per_second'], burst=options['burst'])
+  infakt_client = InfaktClient(logger, 'benchmark', infakt_domain, rate_limiter=rate_limiter, max_connections=options['max_connections'])
+  sync_state = SyncState('state/sync_state.sqlite')
+  incremental_sync = IncrementalSync(logger, sync_state, full_sync_interval=timedelta(days=7))
+  details_concurrency: int = options['details_concurrency']
+
+  if not os.path.exists('data'): os.mkdir('data')
+  account_downloader = AccountDetailsDownloader(logger, infakt_client, infakt_domain, None, details_concurrency=details_concurrency, incremental_sync=incremental_sync, sync_state=sync_state)
+  stage_downloaders = {
+    'accounting': lambda: AccountingDownloader(logger, infakt_client, infakt_domain, None, details_concurrency=details_concurrency, incremental_sync=incremental_sync, sync_state=sync_state).process(),
+    'invoices': lambda: InvoicesDownloader(logger, infakt_client, infakt_domain, None, details_concurrency=details_concurrency, incremental_sync=incremental_sync, sync_state=sync_state).process(),
+    'costs': lambda: CostsDownloader(logger, infakt_client, infakt_domain, None, AttachmentStore(logger, infakt_client, sync_state), details_concurrency=details_concurrency, incremental_sync=incremental_sync, sync_state=sync_state).process()
+  }
+  if stage == 'account':
+    coroutines = [account_downloader.process()]
+  elif stage == 'all':
+    coroutines = [account_downloader.process()] + [downloader() for downloader in stage_downloaders.values()]
+  else:
+    coroutines = [account_downloader.download_account_events(), stage_downloaders[stage]()]
+
+  # The events are looked through in every stage, so the warm runs are incremental as in main.py
+  incremental_sync.expect_plan()
+
+  started_at: float = time.perf_counter()
+  try:
+    results: List[bool] = await asyncio.gather(*coroutines)
+  finally:
+    wall_time: float = time.perf_counter() - started_at
+    await infakt_client.close()
+
+  if all(results): incremental_sync.save()
+  sync_state.close()
+  return {
+    'success': all(results),
+    'wall_time': wall_time,
+    'files_written': write_journal.written,
+    'files_unchanged': write_journal.unchanged,
+    'rate_limiter_wait': rate_limiter.total_wait_time
+  }
+
+def run_stage_process(stage: str, infakt_domain: str, options: Dict[str, Any], work_path: str, queue: multiprocessing.Queue):
+  os.chdir(work_path)
+  logging.basicConfig(level=logging.INFO if options['verbose'] else logging.WARNING, format='[{levelname:<8}] {message}', style='{')
+  try:
+    metrics: Dict[str, Any] = asyncio.run(run_stage(stage, infakt_domain, options))
+  except Exception as e:
+    metrics = { 'success': False, 'error': f'{type(e)} {e}' }
+
+  # Kilobytes on Linux, bytes on macOS
+  peak_rss: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  metrics['peak_rss_mb'] = peak_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+  queue.put(metrics)
+
+def mock_request(mock_url: str, path: str, method: str = 'GET') -> Any:
+  with urllib.request.urlopen(urllib.request.Request(f'{mock_url}{path}', method=method, data=b'' if method == 'POST' else None)) as response:
+    return json.loads(response.read())
+
+def wait_for_mock(mock_url: str, timeout: float = 30):
+  deadline: float = time.monotonic() + timeout
+  while True:
+    try:
+      mock_request(mock_url, '/_mock/stats')
+      return
+    except OSError:
+      if time.monotonic() > deadline:
+        raise Exception('Mock InFakt API did not start')
+      time.sleep(0.1)
+
+def measure_run(context, stage: str, mock_url: str, options: Dict[str, Any], work_path: str) -> Dict[str, Any]:
+  mock_request(mock_url, '/_mock/reset', 'POST')
+  queue = context.Queue()
+  process = context.Process(target=run_stage_process, args=(stage, mock_url, options, work_path, queue))
+  process.start()
+  metrics: Dict[str, Any] = queue.get()
+  process.join()
+
+  # Counted by the server, so the retried requests and the attachment downloads are included
+  mock_stats: Dict[str, Any] = mock_request(mock_url, '/_mock/stats')
+  metrics['requests'] = mock_stats['requests']
+  metrics['bytes'] = mock_stats['bytes']
+  metrics['rate_limited'] = mock_stats['rate_limited']
+  metrics['endpoints'] = mock_stats['endpoints']
+  return metrics
+
+def print_results(results: Dict[str, Dict[str, Dict[str, Any]]]):
+  print(f'{"stage":<12} {"run":<8} {"ok":<3} {"wall [s]":>9} {"requests":>9} {"429s":>6} {"bytes [MB]":>11} {"rss [MB]":>9} {"written":>8} {"unchanged":>10}')
+  for stage, runs in results.items():
+    for run, metrics in runs.items():
+      if 'error' in metrics:
+        print(f'{stage:<12} {run:<8} no  {metrics["error"]}')
+        continue
+      print(f'{stage:<12} {run:<8} {"yes" if metrics["success"] else "no":<3} {metrics["wall_time"]:>9.2f} {metrics["requests"]:>9} {metrics["rate_limited"]:>6} {metrics["bytes"] / (1024 * 1024):>11.1f} {metrics["peak_rss_mb"]:>9.1f} {metrics["files_written"]:>8} {metrics["files_unchanged"]:>10}')
+
+def compare_results(results: Dict[str, Dict[str, Dict[str, Any]]], baseline: Dict[str, Dict[str, Dict[str, Any]]], tolerance: float) -> List[str]:
+  regressions: List[str] = []
+  for stage, runs in results.items():
+    for run, metrics in runs.items():
+      baseline_metrics: Optional[Dict[str, Any]] = baseline.get(stage, {}).get(run)
+      if baseline_metrics is None:
+        continue
+      if baseline_metrics.get('success') and not metrics.get('success'):
+        regressions.append(f'{stage} {run}: failed')
+        continue
+      for metric in COMPARED_METRICS:
+        if metric not in metrics or metric not in baseline_metrics:
+          continue
+        # Small absolute values are noisy, so they are compared against at least one unit
+        if metrics[metric] > max(baseline_metrics[metric], 1) * (1 + tolerance):
+          regressions.append(f'{stage} {run}: {metric} {baseline_metrics[metric]:.2f} -> {metrics[metric]:.2f}')
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description='InFakt sync benchmark against the mock API')
+  parser.add_argument('--stages', default=','.join(STAGES), help=f'comma separated stages ({", ".join(STAGES)})')
+  parser.add_argument('--port', type=int, default=8765)
+  parser.add_argument('--requests-per-second', type=float, default=1000, help='client side rate limit')
+  parser.add_argument('--burst', type=int, default=50)
+  parser.add_argument('--max-connections', type=int, default=10)
+  parser.add_argument('--details-concurrency', type=int, default=8)
+  parser.add_argument('--work-path', help='directory for the synchronized data (a temporary one by default)')
+  parser.add_argument('--output', help='stores the results as JSON')
+  parser.add_argument('--baseline', help='results of an earlier run to compare with')
+  parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative growth of the metrics')
+  parser.add_argument('--verbose', action='store_true', help='shows the logs of the downloaders')
+  add_config_arguments(parser)
+  arguments = parser.parse_args()
+
+  stages: List[str] = [stage.strip() for stage in arguments.stages.split(',') if stage.strip() != '']
+  for stage in stages:
+    if stage not in STAGES:
+      parser.error(f'unknown stage {stage}')
+  options: Dict[str, Any] = {
+    'requests_per_second': arguments.requests_per_second,
+    'burst': arguments.burst,
+    'max_connections': arguments.max_connections,
+    'details_concurrency': arguments.details_concurrency,
+    'verbose': arguments.verbose
+  }
+
+  # Spawned processes start clean (nothing of the parent or the server is inherited)
+  context = multiprocessing.get_context('spawn')
+  mock_url: str = f'http://127.0.0.1:{arguments.port}'
+  mock_process = context.Process(target=serve, args=('127.0.0.1', arguments.port, config_from_arguments(arguments)), daemon=True)
+  mock_process.start()
+  results: Dict[str, Dict[str, Dict[str, Any]]] = {}
+  try:
+    wait_for_mock(mock_url)
+    for stage in stages:
+      work_path: str = os.path.join(arguments.work_path, stage) if arguments.work_path else tempfile.mkdtemp(prefix=f'infakt-benchmark-{stage}-')
+      if os.path.exists(work_path): shutil.rmtree(work_path)
+      os.makedirs(work_path)
+      results[stage] = {}
+      try:
+        for run in RUNS:
+          if run == 'changed': mock_request(mock_url, '/_mock/advance', 'POST')
+          results[stage][run] = measure_run(context, stage, mock_url, options, work_path)
+          print(f'Finished {stage} ({run}) in {results[stage][run].get("wall_time", 0):.2f}s', file=sys.stderr)
+      finally:
+        if not arguments.work_path: shutil.rmtree(work_path, ignore_errors=True)
+  finally:
+    mock_process.terminate()
+    mock_process.join()
+
+  print_results(results)
+  if arguments.output:
+    with open(arguments.output, 'w') as file:
+      json.dump({ 'arguments': vars(arguments), 'results': results }, file, indent=2)
+
+  if arguments.baseline:
+    with open(arguments.baseline, 'r') as file:
+      baseline = json.load(file)['results']
+    regressions: List[str] = compare_results(results, baseline, arguments.tolerance)
+    for regression in regressions:
+      print(f'REGRESSION {regression}')
+    if len(regressions) > 0:
+      sys.exit(1)
+
+  if not all(metrics.get('success') for runs in results.values() for metrics in runs.values()):
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
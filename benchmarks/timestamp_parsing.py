@@ -0,0 +1,40 @@
+# Micro-benchmark of the InFakt timestamp parsing (strptime vs the shared parser)
+# Usage: python benchmarks/timestamp_parsing.py [events count]
+import os
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from models.InfaktDatetime import parse_infakt_datetime, parse_infakt_event_datetime, INFAKT_DATETIME_FORMAT, INFAKT_EVENT_DATETIME_FORMAT
+
+def generate_values(count: int, value_format: str):
+  # Activity log like spread - a few years of events, many of them performed within the same second
+  random.seed(0)
+  start: datetime = datetime(2021, 1, 1, 8, 0, 0)
+  values = []
+  moment: datetime = start
+  for _ in range(count):
+    moment += timedelta(seconds=random.choice([0, 0, 1, 2, 30, 600, 3600]))
+    values.append(moment.strftime(value_format.replace('%z', '+0200' if moment.month in range(4, 11) else '+0100')))
+  return values
+
+def measure(name: str, values, baseline, parser):
+  for value in values[:1000]:
+    assert baseline(value) == parser(value), value
+
+  repeat: int = 5
+  baseline_time: float = min(timeit.repeat(lambda: [baseline(value) for value in values], number=1, repeat=repeat))
+  parser.cache_clear()
+  cold_time: float = timeit.timeit(lambda: [parser(value) for value in values], number=1)
+  warm_time: float = min(timeit.repeat(lambda: [parser(value) for value in values], number=1, repeat=repeat))
+  print(f'{name}: {len(values)} values ({len(set(values))} distinct)')
+  print(f'  strptime      {baseline_time * 1000:8.1f} ms')
+  print(f'  parser (cold) {cold_time * 1000:8.1f} ms  ({baseline_time / cold_time:.1f}x)')
+  print(f'  parser (warm) {warm_time * 1000:8.1f} ms  ({baseline_time / warm_time:.1f}x)')
+
+if __name__ == '__main__':
+  count: int = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  measure('Event timestamps', generate_values(count, INFAKT_EVENT_DATETIME_FORMAT), lambda value: datetime.strptime(value, INFAKT_EVENT_DATETIME_FORMAT), parse_infakt_event_datetime)
+  measure('Timestamps with offsets', generate_values(count, INFAKT_DATETIME_FORMAT), lambda value: datetime.strptime(value, INFAKT_DATETIME_FORMAT), parse_infakt_datetime)
@@ -1,54 +1,268 @@
-import requests
-import time
 import re
-from typing import TypeVar
-from io import BytesIO
+import os
+import shutil
+import asyncio
+import tempfile
+from collections import deque
+from typing import TypeVar, Callable, Awaitable, Iterable, AsyncIterable, AsyncIterator, Deque, Optional, Set, List, Tuple, Any
+from concurrent.futures import ProcessPoolExecutor
 from pypdf import PdfReader, PdfWriter
+from git import Repo
+
+from InfaktClient import InfaktClient, InfaktResponse
 
 T = TypeVar('T')
+R = TypeVar('R')
+
+async def ordered_map(func: Callable[[T], Awaitable[R]], items: Iterable[T] | AsyncIterable[T], concurrency: int) -> AsyncIterator[R]:
+  # Runs up to `concurrency` calls at once, but yields the results in the input order.
+  # Items are pulled lazily, so an async generator of items is consumed only as fast as the results are.
+  async def iterate_items() -> AsyncIterator[T]:
+    if isinstance(items, AsyncIterable):
+      async for item in items:
+        yield item
+    else:
+      for item in items:
+        yield item
+
+  pending: Deque[asyncio.Task] = deque()
+  try:
+    async for item in iterate_items():
+      pending.append(asyncio.ensure_future(func(item)))
+      if len(pending) >= max(concurrency, 1):
+        yield await pending.popleft()
+    while len(pending) > 0:
+      yield await pending.popleft()
+  finally:
+    for task in pending:
+      task.cancel()
+
+# Largest page size accepted by the InFakt API
+INFAKT_MAX_PAGE_LIMIT = 100
+
+def get_total_count(response: InfaktResponse) -> Optional[int]:
+  # Most of the collections keep the count in the metainfo, the activities keep it on the top level
+  content = response.json()
+  if isinstance(content.get('metainfo'), dict) and 'total_count' in content['metainfo']:
+    return int(content['metainfo']['total_count'])
+  if 'total_count' in content:
+    return int(content['total_count'])
+  return None
 
 class Paginator():
-  def __init__(self, session: requests.Session, url: str, limit: int = 100):
+  def __init__(self, client: InfaktClient, url: str, limit: int = INFAKT_MAX_PAGE_LIMIT, concurrency: int = 4):
     self.url = url
     self.limit = limit
-    self.session = session
-  
-  def __iter__(self):
-    self.offset_cnt = 0
-    return self
-
-  def __next__(self):
-    # TODO: Add retrying
-    results = self.session.get(f'{self.url}?limit={self.limit}&offset={self.offset_cnt * self.limit}', headers={
-      "accept": "application/json"
+    self.client = client
+    self.concurrency = concurrency
+
+  def __aiter__(self) -> AsyncIterator[InfaktResponse]:
+    return self.pages()
+
+  async def fetch_page(self, offset: int) -> InfaktResponse:
+    # Retrying and rate limits are handled by the client
+    return await self.client.get(self.url, params={
+      'limit': self.limit,
+      'offset': offset
     })
-    if results.status_code == 429:
-      retryAfter = results.headers['Retry-After']
-      if retryAfter is not None:
-        print(f"Rate limited. Sleeping {retryAfter} seconds")
-        time.sleep(int(retryAfter))
-      
-    self.offset_cnt += 1
-    
-    return results
-
-def dump_to_file(path: str, content: str | bytes):
-  if isinstance(content, bytes):
-    content = content.decode()
-  file = open(path, 'w+', encoding='utf-8')
-  file.write(content)
-  file.close()
-
-def merge_pdfs(pdf_bytes_list: list[bytes]) -> bytes:
+
+  async def pages(self) -> AsyncIterator[InfaktResponse]:
+    first_page = await self.fetch_page(0)
+    yield first_page
+
+    total_count = get_total_count(first_page)
+    if total_count is None:
+      # Unknown collection size - walk the pages until an empty one is returned
+      offset: int = self.limit
+      while True:
+        page = await self.fetch_page(offset)
+        yield page
+        if len(page.json().get('entities') or []) == 0:
+          break
+        offset += self.limit
+      return
+
+    # Fetch the remaining pages concurrently (in order) without the trailing empty page
+    async for page in ordered_map(self.fetch_page, range(self.limit, total_count, self.limit), self.concurrency):
+      yield page
+
+def details_in_list(entity_model, entity_details_model) -> bool:
+  # The details can be built from the listed entity if the detail model adds no fields and changes no types
+  list_fields = entity_model.model_fields
+  details_fields = entity_details_model.model_fields
+  return list_fields.keys() == details_fields.keys() and all(list_fields[name].annotation == details_fields[name].annotation for name in details_fields)
+
+# Records every path changed in the archive, so only these have to be staged
+class WriteJournal():
+  def __init__(self):
+    self.changed_paths: Set[str] = set()
+    self.written: int = 0
+    self.unchanged: int = 0
+
+  def record(self, *paths: str):
+    self.changed_paths.update(os.path.normpath(path) for path in paths)
+
+  def stage(self, repo: Repo, repo_path: str) -> int:
+    # Paths which still exist are added, the other ones are removed from the index
+    relative_paths: List[str] = sorted(os.path.relpath(path, repo_path) for path in self.changed_paths)
+    existing_paths: List[str] = [path for path in relative_paths if os.path.lexists(os.path.join(repo_path, path))]
+    missing_paths: List[str] = [path for path in relative_paths if not os.path.lexists(os.path.join(repo_path, path))]
+
+    with repo.git.custom_environment(GIT_LITERAL_PATHSPECS='1'):
+      for i in range(0, len(existing_paths), 500):
+        repo.git.add('--', *existing_paths[i:i + 500])
+      for i in range(0, len(missing_paths), 500):
+        repo.git.rm('--cached', '--ignore-unmatch', '--quiet', '--', *missing_paths[i:i + 500])
+    return len(relative_paths)
+
+write_journal = WriteJournal()
+
+def dump_to_file(path: str, content: str | bytes) -> bool:
+  if isinstance(content, str):
+    content = content.encode()
+
+  # Leave identical files untouched (keeps the mtime and spares git from rehashing them)
+  try:
+    if os.path.getsize(path) == len(content):
+      with open(path, 'rb') as file:
+        if file.read() == content:
+          write_journal.unchanged += 1
+          return False
+  except OSError:
+    pass # Missing file
+
+  with open(path, 'wb') as file:
+    file.write(content)
+  write_journal.written += 1
+  write_journal.record(path)
+  return True
+
+def dump_stream_to_file(path: str, chunks: Iterable[bytes]) -> bool:
+  # Streams the content into a temporary file and replaces the target only if the content differs
+  temporary_path: str = f'{path}.tmp'
+  with open(temporary_path, 'wb') as file:
+    for chunk in chunks:
+      file.write(chunk)
+  return replace_file(temporary_path, path)
+
+def replace_file(temporary_path: str, path: str) -> bool:
+  # Moves the complete temporary file over the target, leaving identical files untouched
+  if os.path.exists(path) and os.path.getsize(path) == os.path.getsize(temporary_path):
+    with open(path, 'rb') as existing_file, open(temporary_path, 'rb') as new_file:
+      while (existing_chunk := existing_file.read(1024 * 1024)) == new_file.read(1024 * 1024):
+        if len(existing_chunk) == 0:
+          os.remove(temporary_path)
+          write_journal.unchanged += 1
+          return False
+
+  os.replace(temporary_path, path)
+  write_journal.written += 1
+  write_journal.record(path)
+  return True
+
+# Collects JSON list items on disk and writes them out sorted, without keeping the entities in memory
+class SortedJsonListSpool():
+  def __init__(self):
+    self.file = tempfile.TemporaryFile()
+    self.index: List[Tuple[Any, int, int, int]] = [] # (sort key, arrival order, offset, length)
+
+  def add(self, sort_key: Any, content: str | bytes):
+    if isinstance(content, str):
+      content = content.encode()
+    offset: int = self.file.seek(0, os.SEEK_END)
+    self.file.write(content)
+    self.index.append((sort_key, len(self.index), offset, len(content)))
+
+  def chunks(self) -> Iterable[bytes]:
+    # Same layout as the indented pydantic list dump
+    if len(self.index) == 0:
+      yield b'[]'
+      return
+    yield b'[\n'
+    for i, (_, _, offset, length) in enumerate(sorted(self.index)):
+      self.file.seek(offset)
+      item: bytes = self.file.read(length)
+      yield (b',\n' if i > 0 else b'') + b'  ' + item.replace(b'\n', b'\n  ')
+    yield b'\n]'
+
+  def write_to(self, path: str) -> bool:
+    try:
+      return dump_stream_to_file(path, self.chunks())
+    finally:
+      self.file.close()
+
+def rename_file(source_path: str, target_path: str):
+  os.rename(source_path, target_path)
+  write_journal.record(source_path, target_path)
+
+def remove_file(path: str):
+  os.remove(path)
+  write_journal.record(path)
+
+def rename_directory(source_path: str, target_path: str):
+  # Git tracks the files only, so all of them are recorded under both paths
+  relative_paths: List[str] = [os.path.relpath(os.path.join(root, file_name), source_path) for root, _, file_names in os.walk(source_path) for file_name in file_names]
+  os.rename(source_path, target_path)
+  for relative_path in relative_paths:
+    write_journal.record(os.path.join(source_path, relative_path), os.path.join(target_path, relative_path))
+
+def link_file(source_path: str, target_path: str) -> bool:
+  # Hard links share the stored content instead of copying it (falls back to a copy across file systems)
+  if os.path.exists(target_path):
+    if os.path.samefile(source_path, target_path):
+      return False
+    os.remove(target_path)
+  try:
+    os.link(source_path, target_path)
+  except OSError:
+    shutil.copyfile(source_path, target_path)
+  write_journal.record(target_path)
+  return True
+
+def merge_pdfs(input_paths: List[str], output_path: str, max_pages: Optional[int] = None, max_size: Optional[int] = None) -> int:
+  # Works on files only, so neither the inputs nor the output have to be kept in memory
+  if max_size is not None and sum(os.path.getsize(path) for path in input_paths) > max_size:
+    raise Exception('PDF files exceed the size limit')
+
   writer = PdfWriter()
+  page_count: int = 0
+  input_files = []
+  try:
+    for input_path in input_paths:
+      # Kept before the reader is built, so a corrupted input gets closed as well
+      input_file = open(input_path, 'rb')
+      input_files.append(input_file)
+      reader = PdfReader(input_file)
+      page_count += len(reader.pages)
+      if max_pages is not None and page_count > max_pages:
+        raise Exception('PDF files exceed the page limit')
+      for page in reader.pages:
+        writer.add_page(page)
+
+    with open(output_path, 'wb') as output_file:
+      writer.write(output_file)
+  finally:
+    for input_file in input_files:
+      input_file.close()
+
+  if max_size is not None and os.path.getsize(output_path) > max_size:
+    os.remove(output_path)
+    raise Exception('Merged PDF exceeds the size limit')
+  return page_count
+
+pdf_merge_executor: Optional[ProcessPoolExecutor] = None
 
-  for pdf_bytes in pdf_bytes_list:
-    reader = PdfReader(BytesIO(pdf_bytes))
-    for page in reader.pages:
-      writer.add_page(page)
+async def merge_pdfs_async(input_paths: List[str], output_path: str, max_pages: Optional[int] = None, max_size: Optional[int] = None) -> int:
+  # pypdf is CPU bound, so it runs in the worker processes instead of the event loop thread
+  global pdf_merge_executor
+  if pdf_merge_executor is None:
+    pdf_merge_executor = ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, 4))
+  return await asyncio.get_running_loop().run_in_executor(pdf_merge_executor, merge_pdfs, input_paths, output_path, max_pages, max_size)
 
-  output_stream = BytesIO()
-  writer.write(output_stream)
-  return output_stream.getvalue()
+def shutdown_pdf_merge_executor():
+  global pdf_merge_executor
+  if pdf_merge_executor is not None:
+    pdf_merge_executor.shutdown()
+    pdf_merge_executor = None
 
-UUID_REGEX = re.compile(r'\b' + '-'.join([rf'[0-9a-fA-F]{x}' for x in [8, 4, 4, 4, 12]]) + r'\b')
\ No newline at end of file
+UUID_REGEX = re.compile(r'\b' + '-'.join([rf'[0-9a-fA-F]{{{x}}}' for x in [8, 4, 4, 4, 12]]) + r'\b')
\ No newline at end of file
@@ -2,25 +2,30 @@ import asyncio
 import logging
 from logging.handlers import RotatingFileHandler
 import sys
-import requests
 import json
 import os
-import time
-import urllib
-from io import BytesIO
+import tempfile
 from dotenv import load_dotenv
 from pypaperless import Paperless
 from pypaperless.models.common import TaskStatusType
 from git import Repo
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import List
 
-from helpers import Paginator, merge_pdfs
+from helpers import Paginator, merge_pdfs_async, shutdown_pdf_merge_executor, ordered_map, write_journal
+from InfaktClient import InfaktClient
+from RateLimiter import RateLimiter
+from IncrementalSync import IncrementalSync
+from SyncState import SyncState
+from AttachmentStore import AttachmentStore
+from PaperlessTaskPoller import PaperlessTaskPoller
+from PaperlessMetadata import PaperlessMetadata
 from models.InfaktCosts import InfaktCostsResponse, InfaktCostEntityDetailed
 from AccountDetailsDownloader import AccountDetailsDownloader
 from AccountingDownloader import AccountingDownloader
 from InvoicesDownloader import InvoicesDownloader
 from CostsUploader import CostsUploader
+from CostsDownloader import CostsDownloader
 
 load_dotenv() # Load the dotenv
 
@@ -49,12 +54,52 @@ if os.getenv('PAPERLESS_URL') is not None and os.getenv('PAPERLESS_TOKEN') is no
 else:
   logger.info('Not setting up paperless due to lack of credentials.')
 
-# Set up InFakt session
-infakt_session = requests.Session()
-infakt_session.headers.update({
-  "X-inFakt-ApiKey": os.getenv('INFAKT_API_KEY')
-})
+# Set up InFakt client
 infakt_domain = os.getenv('INFAKT_API_DOMAIN') or 'https://api.infakt.pl'
+infakt_rate_limiter = RateLimiter(
+  float(os.getenv('INFAKT_REQUESTS_PER_SECOND') or 5),
+  burst=int(os.getenv('INFAKT_RATE_LIMIT_BURST') or 5)
+)
+infakt_client = InfaktClient(
+  logger,
+  os.getenv('INFAKT_API_KEY'),
+  infakt_domain,
+  rate_limiter=infakt_rate_limiter,
+  max_connections=int(os.getenv('INFAKT_MAX_CONNECTIONS') or 10)
+)
+details_concurrency = int(os.getenv('INFAKT_DETAILS_CONCURRENCY') or 8)
+
+# Uploading of the documents from Paperless to InFakt
+upload_batch_size = int(os.getenv('INFAKT_UPLOAD_BATCH_SIZE') or 10)
+upload_concurrency = int(os.getenv('INFAKT_UPLOAD_CONCURRENCY') or 4)
+
+# Limits of the merged attachment PDFs
+pdf_merge_max_pages = int(os.getenv('PDF_MERGE_MAX_PAGES')) if os.getenv('PDF_MERGE_MAX_PAGES') else None
+pdf_merge_max_size = int(float(os.getenv('PDF_MERGE_MAX_SIZE_MB')) * 1024 * 1024) if os.getenv('PDF_MERGE_MAX_SIZE_MB') else None
+
+# Open the state kept between the runs
+sync_state = SyncState(os.getenv('SYNC_STATE_PATH') or 'state/sync_state.sqlite')
+
+# Paperless metadata looked up by the names
+paperless_metadata = PaperlessMetadata(
+  logger,
+  paperless,
+  sync_state,
+  ttl=timedelta(hours=float(os.getenv('PAPERLESS_METADATA_TTL_HOURS') or 24))
+) if paperless is not None else None
+paperless_upload_tag = os.getenv('PAPERLESS_UPLOAD_TAG') or 'TO UPLOAD'
+paperless_scan_uuid_field = os.getenv('PAPERLESS_SCAN_UUID_FIELD') or 'InFakt Scan UUID'
+paperless_cost_uuid_field = os.getenv('PAPERLESS_COST_UUID_FIELD') or 'InFakt UUID'
+paperless_cost_tags = [name.strip() for name in (os.getenv('PAPERLESS_COST_TAGS') or 'InFakt,Dokumenty firmowe').split(',') if name.strip() != '']
+paperless_cost_document_type = os.getenv('PAPERLESS_COST_DOCUMENT_TYPE') or 'Infakt Faktura Kosztowa'
+
+# Set up the incremental synchronization (based on the account activity log)
+incremental_sync = IncrementalSync(
+  logger,
+  sync_state,
+  full_sync_interval=timedelta(days=float(os.getenv('INFAKT_FULL_SYNC_INTERVAL_DAYS') or 7)),
+  force_full_sync=os.getenv('INFAKT_FULL_SYNC') == '1'
+)
 
 # Prepare the data folder
 if not os.path.exists('data'):
@@ -62,144 +107,131 @@ if not os.path.exists('data'):
 # Init the git repo
 data_repo: Repo = Repo.init('data')
 
+# Cost attachments shared by the downloader and the Paperless sync
+attachment_store = AttachmentStore(logger, infakt_client, sync_state)
+
 async def main():
   if paperless is not None: await paperless.initialize()
 
-  results: List[bool] = [
-    await CostsUploader(logger, infakt_session, infakt_domain, paperless).process(),
-    await AccountDetailsDownloader(logger, infakt_session, infakt_domain, paperless).process(),
-    await AccountingDownloader(logger, infakt_session, infakt_domain, paperless).process(),
-    await InvoicesDownloader(logger, infakt_session, infakt_domain, paperless).process()
-  ]
-  all_success = all(results)
+  # The write journal lives in memory, so the changes of a run killed before the commit are staged in full
+  previous_run_interrupted: bool = sync_state.get_metadata('staging_pending') is not None
+  sync_state.set_metadata('staging_pending', datetime.now().isoformat())
+  sync_state.commit()
 
-  if paperless is not None: await paperless.close()
+  upload_success: bool = True
+
+  async def sync_costs() -> bool:
+    # The costs uploaded from Paperless are downloaded within the same run
+    nonlocal upload_success
+    upload_success = await CostsUploader(logger, infakt_client, infakt_domain, paperless, paperless_metadata=paperless_metadata, upload_tag_name=paperless_upload_tag, scan_uuid_field_name=paperless_scan_uuid_field, upload_batch_size=upload_batch_size, upload_concurrency=upload_concurrency).process()
+    return await CostsDownloader(logger, infakt_client, infakt_domain, paperless, attachment_store, details_concurrency=details_concurrency, incremental_sync=incremental_sync, sync_state=sync_state).process()
 
-  # Stage all the changes
-  data_repo.git.add(A=True)
+  # The account events are looked through by AccountDetailsDownloader, the other stages wait for the plan
+  incremental_sync.expect_plan()
+
+  # The stages use disjoint endpoints and directories, so they run concurrently under the shared client limits
+  results: List[bool] = await asyncio.gather(
+    sync_costs(),
+    AccountDetailsDownloader(logger, infakt_client, infakt_domain, paperless, details_concurrency=details_concurrency, incremental_sync=incremental_sync, sync_state=sync_state).process(),
+    AccountingDownloader(logger, infakt_client, infakt_domain, paperless, details_concurrency=details_concurrency, incremental_sync=incremental_sync, sync_state=sync_state).process(),
+    InvoicesDownloader(logger, infakt_client, infakt_domain, paperless, details_concurrency=details_concurrency, incremental_sync=incremental_sync, sync_state=sync_state).process()
+  )
+  download_success: bool = all(results)
+  all_success: bool = download_success and upload_success
+
+  # Move the watermark only if everything got downloaded (the uploads to InFakt do not depend on it)
+  if download_success: incremental_sync.save()
+
+  logger.info('Wrote %d files (%d were left unchanged)', write_journal.written, write_journal.unchanged)
+  logger.info('InFakt requests spent %.2fs in total waiting for the rate limiter (%d requests)', infakt_rate_limiter.total_wait_time, infakt_rate_limiter.acquired_count)
+
+  await infakt_client.close()
+  if paperless is not None: await paperless.close()
+  shutdown_pdf_merge_executor()
+
+  # Stage the changes
+  if os.getenv('GIT_FULL_STAGING') == '1' or previous_run_interrupted:
+    if previous_run_interrupted: logger.info('Previous run did not reach the commit - staging all the changes')
+    data_repo.git.add(A=True)
+  else:
+    staged_count: int = write_journal.stage(data_repo, 'data')
+    logger.info('Staged %d changed paths', staged_count)
   data_repo.index.commit(
     message='Syncing InFakt at %s - %s' % (datetime.now().strftime('%Y-%m-%d %H:%M:%S %z'), 'SUCCESS' if all_success else 'ERROR')
   )
 
-    return
-    # Syncing the documents from paperless to InFakt
-    to_upload_infakt_tag = await paperless.tags(6)
-    async for document in paperless.documents.search(f'tag:"{to_upload_infakt_tag.name}"'):
-      document.tags.remove(to_upload_infakt_tag.id) # Remove the tag
-      await document.update()
-
-      content = await document.get_download()
-      print("Got content", type(content.content))
-      
-      upload_result = infakt_session.post(
-        'https://api.sandbox-infakt.pl/api/v3/documents/costs/upload.json',
-        data={},
-        files=[
-          (
-            "uploads[]",
-            (content.disposition_filename, BytesIO(content.content), 'application/octet-stream')
-          )
-        ]
-      )
-
-      print(upload_result)
-      print(upload_result.json())
-
-      print(InfaktUploadResponse.model_validate(upload_result.json()))
-
-    return
-
-    for costs_result in Paginator(infakt_session, 'https://api.infakt.pl/api/v3/documents/costs.json'):
-      parsed_costs: InfaktCostsResponse = InfaktCostsResponse.model_validate(costs_result.json())
-
-      if len(parsed_costs.entities) == 0:
-        break
-
-      i = 0
-      for cost in parsed_costs.entities:
-        i += 1
-        if i == 11:
-          return # Up to 3 docs
-
-        cost_details_result = infakt_session.get(f'https://api.infakt.pl/api/v3/documents/costs/{cost.uuid}.json', headers={
-          "accept": "application/json"
-        }) # TODO: Also handle ratelimits
-
-        parsed_cost_details = InfaktCostEntityDetailed.model_validate(cost_details_result.json())
-
-        attachments = []
-        for attachment_data in parsed_cost_details.attachments:
-          attachment_content = urllib.request.urlopen(attachment_data.download_url).read()
-          attachments.append(attachment_content)
-        merged_attachments = merge_pdfs(attachments) if len(attachments) > 1 else attachments[0]
-
-        infakt_uuid_field = await paperless.custom_fields(1)
-        doc_uuid_field_value = infakt_uuid_field.draft_value(cost.uuid)
-
-        doc = paperless.documents.draft(
-          document=merged_attachments,
-          title=f'Test document infakt {cost.uuid}',
-          filename=f'{cost.uuid}.pdf',
-          created=cost.created_at,
-          tags=[2, 5] # Infakt Faktura ID (Tag Dokumenty firmowe; to do)
-        )
-
-        task_id = await doc.save()
-        task = await paperless.tasks(task_id)
-        while task.status in [TaskStatusType.PENDING, TaskStatusType.STARTED]:
-          time.sleep(2)
-          await task.load()
-        
-        if task.status == TaskStatusType.SUCCESS:
-          print("Success!", task.related_document)
-          saved_doc = await paperless.documents(task.related_document)
-          saved_doc.custom_fields += doc_uuid_field_value
-          saved_doc.document_type = 12 # Infakt Faktura Kosztowa
-          await saved_doc.update()
-
-          note_draft = saved_doc.notes.draft()
-          note_draft.note = json.dumps(json.loads(parsed_cost_details.model_dump_json()), indent=2)
-          await note_draft.save()
-        elif task.status == TaskStatusType.FAILURE:
-          print("Failure!", task.related_document)
-
-          #file_path = f'{dir_path}/attachments/{attachment_data.get("file_name")}'
-          #if not os.path.isfile(file_path):
-          #  urllib.request.urlretrieve(attachment_data.get("download_url"), file_path)
-          # Setting file_url and download_url to null as it always changes
-          #attachment_data.pop('download_url')
-          #attachment_data.pop('file_url')
-
-
-        '''     
-        isRejected = False
-        for status in json_detail_result.get('statuses'):
-          if status.get('symbol') == "cost_rejected":
-            isRejected = True
-            break
-
-        dir_path = f'data/costs/{entity.get("issue_date")} - {uuid}'
-        if isRejected:
-          dir_path += ' (REJECTED)'
-
-        try:
-          os.mkdir(dir_path)
-        except Exception as e:
-          pass
-        
-        file = open(f'{dir_path}/data.json', "w+")
-        file.write(json.dumps(entity, indent=2))
-        file.close()
-
-        try:
-          os.mkdir(f'{dir_path}/attachments')
-        except Exception as e:
-          pass
-
-
-        file = open(f'{dir_path}/detailed_data.json', "w+")
-        file.write(json.dumps(json_detail_result, indent=2))
-        file.close()
-        '''
-
-asyncio.run(main())
+  # Everything written so far is committed now
+  sync_state.set_metadata('staging_pending', None)
+  sync_state.commit()
+  sync_state.close()
+
+# Syncing the costs from InFakt to Paperless (not scheduled yet)
+async def sync_costs_to_paperless(limit: int = 10, concurrency: int = 10):
+  task_poller = PaperlessTaskPoller(logger, paperless)
+  infakt_uuid_field = await paperless_metadata.custom_field(paperless_cost_uuid_field)
+  cost_tags = await paperless_metadata.tags(paperless_cost_tags)
+  cost_document_type = await paperless_metadata.document_type(paperless_cost_document_type)
+
+  async def sync_cost(cost):
+    cost_details_result = await infakt_client.get(f'{infakt_domain}/api/v3/documents/costs/{cost.uuid}.json')
+
+    parsed_cost_details = InfaktCostEntityDetailed.model_validate_json(cost_details_result.content)
+
+    attachment_paths = [await attachment_store.fetch(attachment_data) for attachment_data in parsed_cost_details.attachments]
+    if len(attachment_paths) > 1:
+      merged_path = os.path.join(tempfile.gettempdir(), f'{cost.uuid}.pdf')
+      await merge_pdfs_async(attachment_paths, merged_path, max_pages=pdf_merge_max_pages, max_size=pdf_merge_max_size)
+    else:
+      merged_path = attachment_paths[0]
+    with open(merged_path, 'rb') as merged_file:
+      merged_attachments = merged_file.read()
+    if len(attachment_paths) > 1: os.remove(merged_path)
+
+    doc_uuid_field_value = infakt_uuid_field.draft_value(cost.uuid)
+
+    doc = paperless.documents.draft(
+      document=merged_attachments,
+      title=f'Test document infakt {cost.uuid}',
+      filename=f'{cost.uuid}.pdf',
+      created=cost.created_at,
+      tags=[tag.id for tag in cost_tags]
+    )
+
+    # Wait for the consumption together with the other documents
+    task_id = await doc.save()
+    try:
+      task = await task_poller.wait(task_id)
+    except Exception as e:
+      logger.error('Failed to wait for the Paperless consumption of the cost %s - %s %s', cost.uuid, type(e), e)
+      return
+    
+    if task.status == TaskStatusType.SUCCESS:
+      logger.info('Consumed the cost %s in Paperless as the document %s', cost.uuid, task.related_document)
+      saved_doc = await paperless.documents(task.related_document)
+      saved_doc.custom_fields += doc_uuid_field_value
+      saved_doc.document_type = cost_document_type.id
+      await saved_doc.update()
+
+      note_draft = saved_doc.notes.draft()
+      note_draft.note = json.dumps(json.loads(parsed_cost_details.model_dump_json()), indent=2)
+      await note_draft.save()
+    elif task.status == TaskStatusType.FAILURE:
+      logger.error('Paperless failed to consume the cost %s - %s', cost.uuid, task.result)
+
+  costs = []
+  async for costs_result in Paginator(infakt_client, f'{infakt_domain}/api/v3/documents/costs.json'):
+    parsed_costs: InfaktCostsResponse = InfaktCostsResponse.model_validate_json(costs_result.content)
+
+    if len(parsed_costs.entities) == 0:
+      break
+    costs.extend(parsed_costs.entities)
+    if len(costs) >= limit:
+      break
+
+  # Documents are uploaded and consumed in parallel
+  async for _ in ordered_map(sync_cost, costs[:limit], concurrency):
+    pass
+
+# The PDF merging workers import this module again (spawn and forkserver start methods), so they must not run the sync
+if __name__ == '__main__':
+  asyncio.run(main())
@@ -7,6 +7,7 @@ from pydantic_extra_types.country import CountryAlpha2
 from models.InfaktInvoices import InfaktInvoiceEntityBusinessActivityKind
 
 from models.InfaktPaginateResponseMetainfo import InfaktPaginateResponseMetainfo
+from models.InfaktDatetime import parse_infakt_datetime
 
 class InfaktAccountDataRole(str, Enum):
   OWNER = 'owner'
@@ -26,7 +27,7 @@ class InfaktAccountData(BaseModel, extra='forbid'):
   @classmethod
   def parse_custom_registered_at(cls, value):
     if isinstance(value, datetime): return value
-    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S %z')
+    return parse_infakt_datetime(value)
 
 class InfaktCompanyData(BaseModel, extra='forbid'):
   first_name: str
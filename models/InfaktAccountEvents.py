@@ -2,6 +2,7 @@ from pydantic import BaseModel, field_validator
 from enum import Enum
 from datetime import datetime, date as ddate
 from typing import Optional, List
+from models.InfaktDatetime import parse_infakt_event_datetime
 
 class InfaktAccountEventSubjectDataFormDataAddress(BaseModel, extra='forbid'):
   city: str
@@ -134,7 +135,7 @@ class InfaktAccountEvent(BaseModel, extra='forbid'):
   @classmethod
   def parse_custom_performed_at(cls, value):
     if isinstance(value, datetime): return value
-    return datetime.strptime(value, '%Y-%m-%d, %H:%M:%S')
+    return parse_infakt_event_datetime(value)
 
 class InfaktAccountEventsResponse(BaseModel, extra='forbid'):
   total_count: int
@@ -4,6 +4,7 @@ from typing import Optional, List
 from pydantic import BaseModel, field_validator
 from pydantic_extra_types.currency_code import Currency
 from models.InfaktPaginateResponseMetainfo import InfaktPaginateResponseMetainfo
+from models.InfaktDatetime import parse_infakt_datetime
 
 class InfaktCostEntitySource(str, Enum):
   INFAKT = 'infakt'
@@ -98,7 +99,7 @@ class InfaktCostEntity(BaseModel, extra='forbid'):
   @classmethod
   def parse_custom_created_at(cls, value):
     if isinstance(value, datetime): return value
-    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S %z')
+    return parse_infakt_datetime(value)
   
 class InfaktCostAttachmentKind(IntEnum): # ???
   INVOICE = 21
@@ -0,0 +1,25 @@
+from datetime import datetime
+from functools import lru_cache
+
+INFAKT_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S %z' # 2024-03-05 10:11:12 +0100
+INFAKT_EVENT_DATETIME_FORMAT = '%Y-%m-%d, %H:%M:%S' # 2024-03-05, 10:11:12
+
+# strptime is slow, so the fixed layouts are rearranged into ISO format and parsed natively
+# Anything unexpected goes through strptime, which keeps its validation and errors
+@lru_cache(maxsize=4096)
+def parse_infakt_datetime(value: str) -> datetime:
+  if len(value) == 25 and value[10] == ' ' and value[19] == ' ' and value[20] in '+-':
+    try:
+      return datetime.fromisoformat(value[:19] + value[20:])
+    except ValueError:
+      pass
+  return datetime.strptime(value, INFAKT_DATETIME_FORMAT)
+
+@lru_cache(maxsize=4096)
+def parse_infakt_event_datetime(value: str) -> datetime:
+  if len(value) == 20 and value[10:12] == ', ':
+    try:
+      return datetime.fromisoformat(value[:10] + ' ' + value[12:])
+    except ValueError:
+      pass
+  return datetime.strptime(value, INFAKT_EVENT_DATETIME_FORMAT)
@@ -6,6 +6,7 @@ from enum import Enum
 from datetime import date as ddate, datetime
 
 from models.InfaktPaginateResponseMetainfo import InfaktPaginateResponseMetainfo
+from models.InfaktDatetime import parse_infakt_datetime
 
 class InfaktInvoiceEntityStatus(str, Enum):
   DRAFT = 'draft'
@@ -66,13 +67,13 @@ class InfaktInvoiceEntityKsefDataTimestamps(BaseModel, extra='forbid'):
   @classmethod
   def parse_custom_request_created_at(cls, value):
     if isinstance(value, datetime): return value
-    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S %z')
+    return parse_infakt_datetime(value)
   
   @field_validator('request_finished_at', mode='before')
   @classmethod
   def parse_custom_request_finished_at(cls, value):
     if isinstance(value, datetime): return value
-    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S %z')
+    return parse_infakt_datetime(value)
 
 class InfaktInvoiceEntityKsefData(BaseModel, extra='forbid'):
   request_uuid: str